@@ -0,0 +1,237 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import simulateLocationPref as loc_file
+import recommenderSystem as rec_file
+from campusMap import CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, TREE_COUNTS, SEASONS, DEFAULT_AVG_RAIN, DEFAULT_AVG_TEMP
+
+# renderers of the current process, built once by setup
+_RENDERERS = {}
+
+
+class BlitFigure:
+    def __init__(self, figsize=(8, 6), dpi=100):
+        """
+        Agg figure drawn in full once; afterwards only its animated artists are redrawn over the saved background
+
+        Parameters:
+        figsize: tuple
+            (width, height) of the figure in inches
+        dpi: int
+            resolution of the saved pngs
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.dpi = dpi
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.animated = []
+        self.background = None
+
+    def animate(self, *artists):
+        # artists whose data changes between frames, drawn in this order on top of the background
+        for artist in artists:
+            artist.set_animated(True)
+            self.animated.append(artist)
+
+    def save(self, path):
+        import matplotlib.image
+
+        if self.background is None:
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.canvas.restore_region(self.background)
+        for artist in self.animated:
+            self.fig.draw_artist(artist)
+        matplotlib.image.imsave(path, np.asarray(self.canvas.buffer_rgba()), dpi=self.dpi)
+
+
+class PreferenceMapRenderer(BlitFigure):
+    def __init__(self, pref, levels=50, dpi=100):
+        """
+        Off-screen version of LocationPref.visualize that keeps one figure and only swaps the pdf between frames
+
+        Parameters:
+        pref: LocationPref
+            preference model whose grid, campus boundary and location centers are drawn
+        levels: int
+            number of color bands, like the contour levels of visualize
+        dpi: int
+            resolution of the saved pngs
+        """
+        import matplotlib
+
+        super().__init__(dpi=dpi)
+        pref.build_grid()
+        self.pref = pref
+        ax = self.ax = self.fig.add_subplot()
+
+        # a banded image instead of contourf, contour sets can't be updated in place
+        x1, x2, y1, y2 = pref.campus_boundary
+        self.image = ax.imshow(np.zeros(pref.X.shape), origin="lower", extent=(x1, x2, y1, y2), aspect="auto",
+                               cmap=matplotlib.colormaps["Blues"].resampled(levels), alpha=0.7)
+        self.colorbar = self.fig.colorbar(self.image, ax=ax, label='Probability Density')
+
+        labels = [ax.text(x, y, label, fontsize=10, ha='center', va='center', color='black', fontweight='bold')
+                  for label, (x, y) in pref.dict.items()]
+        ax.set_xlabel('X Coordinate')
+        ax.set_ylabel('Y Coordinate')
+        ax.set_xlim(x1, x2)
+        ax.set_ylim(y1, y2)
+        self.fig.tight_layout()
+
+        # the colorbar scale follows the peak of each pdf, so its ticks are redrawn along with the image
+        self.animate(self.image, *labels, *ax.spines.values(), self.colorbar.ax.yaxis)
+
+    def render(self, pdf, path):
+        self.image.set_data(pdf)
+        self.image.set_clim(0, max(float(np.max(pdf)), 1e-12))
+        self.save(path)
+
+
+class FruitBarRenderer(BlitFigure):
+    def __init__(self, map_locs, dpi=100):
+        """
+        Off-screen version of RecommendTrees.visualize that keeps one bar chart and only changes the bar heights
+
+        Parameters:
+        map_locs: dict
+            {location: [(x1, x2), (y1, y2)]} location registry the bars are labeled and ordered by
+        dpi: int
+            resolution of the saved pngs
+        """
+        super().__init__(dpi=dpi)
+        self.map_locs = map_locs
+        ax = self.ax = self.fig.add_subplot()
+
+        labels = [loc for loc, coords in map_locs.items() if len(coords) == 2]
+        self.bars = ax.bar(labels, np.ones(len(labels)))
+        ax.set_xlabel('Locations')
+        ax.set_ylabel('Probabilities')
+        self.title = ax.set_title("Probability Distribution of Finding Fruits")
+        self.animate(*self.bars, ax.yaxis, ax.spines["bottom"], self.title)
+
+    def render(self, scaled_values, path, title=None):
+        _, probs = rec_file.location_probabilities(scaled_values, self.map_locs)
+        for bar, prob in zip(self.bars, probs):
+            bar.set_height(prob)
+        self.ax.set_ylim(0, max(float(np.max(probs, initial=0)), 1e-12) * 1.05)
+        if title is not None:
+            self.title.set_text(title)
+        self.save(path)
+
+
+def setup(grid_size=100):
+    """
+    Build the preference model and both renderers once per worker process
+    """
+    pref = loc_file.LocationPref(CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, grid_size=grid_size, mode="analytic")
+    _RENDERERS["pref"] = pref
+    _RENDERERS["map"] = PreferenceMapRenderer(pref)
+    _RENDERERS["bars"] = FruitBarRenderer(STANFORD_MAP_LOCS)
+
+
+def render_user(job, out_dir):
+    """
+    Write the preference map and fruit bar chart of one user. Returns a summary dict of the report.
+
+    job: dict
+        {"user": id, "locations": [preferred locations], "fruit": fruit, "avg_rain": float, "avg_temp": float},
+        the weather defaults to the gui defaults
+    out_dir: string
+        directory the pngs are written to, as <user>_preferences.png and <user>_fruit.png
+    """
+    if not _RENDERERS:
+        setup()
+    pref = _RENDERERS["pref"]
+    user, locs, fruit = str(job["user"]), job["locations"], job["fruit"]
+    avg_rain, avg_temp = job.get("avg_rain", DEFAULT_AVG_RAIN), job.get("avg_temp", DEFAULT_AVG_TEMP)
+
+    report = {"user": user, "preferences": os.path.join(out_dir, f"{user}_preferences.png")}
+    _RENDERERS["map"].render(pref.create_pref_pdf(locs), report["preferences"])
+
+    rec_obj = rec_file.RecommendTrees(pref.pref_probability_locs(locs), TREE_COUNTS, SEASONS)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            scaled_values, report["best"] = rec_obj.recommend_location(CAMPUS_BOUNDS, STANFORD_MAP_LOCS, fruit, None, avg_rain, avg_temp)
+    except (ValueError, ZeroDivisionError) as e:
+        # not enough historical data for this weather, so there is no fruit chart
+        report["error"] = str(e)
+        return report
+
+    report["fruit"] = os.path.join(out_dir, f"{user}_fruit.png")
+    _RENDERERS["bars"].render(scaled_values, report["fruit"], title=f"Probability of Finding {fruit.capitalize()}s")
+    return report
+
+
+def render_reports(jobs, out_dir, workers=None, grid_size=100, chunk_size=None):
+    """
+    Render the reports of many users, split over worker processes that each reuse their own figures
+
+    Parameters:
+    jobs: list
+        one dict per user, see render_user
+    out_dir: string
+        directory for the pngs, created if needed
+    workers: int or None
+        number of processes, 1 renders in this process and None uses every cpu
+    grid_size: int
+        grid cells along each side of the preference maps
+    chunk_size: int or None
+        jobs sent to a worker at a time, by default about four chunks per worker
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if workers == 1:
+        setup(grid_size)
+        return [render_user(job, out_dir) for job in jobs]
+
+    workers = workers or os.cpu_count() or 1
+    chunk_size = chunk_size or max(1, -(-len(jobs) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=setup, initargs=(grid_size,)) as executor:
+        return list(executor.map(render_user, jobs, repeat(out_dir), chunksize=chunk_size))
+
+
+def random_jobs(n_users, seed=None):
+    """
+    Reports for n_users simulated users with 1 to 3 preferred locations and a random fruit
+    """
+    rng = np.random.default_rng(seed)
+    locs, fruits = list(STANFORD_MAP_LOCS), list(SEASONS)
+    return [{"user": f"user{i}", "locations": rng.choice(locs, size=rng.integers(1, 4), replace=False).tolist(),
+             "fruit": str(rng.choice(fruits))} for i in range(n_users)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render BirdFeeder report plots for many users without a display.")
+    parser.add_argument("--input", default=None, help="json list of jobs, see render_user")
+    parser.add_argument("--users", type=int, default=100, help="number of simulated users when no --input is given")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the simulated users")
+    parser.add_argument("--out", default="reports", help="directory the pngs are written to")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--grid-size", type=int, default=100, help="grid cells along each side of the preference maps")
+    args = parser.parse_args(argv)
+
+    if args.input is not None:
+        with open(args.input, "r") as f:
+            jobs = json.load(f)
+    else:
+        jobs = random_jobs(args.users, args.seed)
+
+    start = time.perf_counter()
+    reports = render_reports(jobs, args.out, args.workers, args.grid_size)
+    elapsed = time.perf_counter() - start
+    failed = sum("error" in report for report in reports)
+    print(f"Rendered {len(reports)} reports to {args.out} in {elapsed:.2f} s ({failed} without a fruit chart)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
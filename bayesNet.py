@@ -0,0 +1,356 @@
+import json
+import numpy as np
+
+import precision
+
+
+class BayesNet:
+    def __init__(self, nodes):
+        """
+        Initialize a Bayes net over binary nodes with its CPTs as numpy arrays. The joint table used by the exact
+        queries has 2^n rows, so it is only built on the first exact query; sampling never needs it.
+
+        Parameters:
+        nodes: list
+            [{"name": name, "parents": [parent names], "cpt": P(node = 1 | parents)}, ...]
+            The cpt is a number for nodes without parents and otherwise a nested list indexed by the parent values
+            in the order of "parents", e.g. cpt[wind][cloudy] for a node with parents ["wind", "cloudy"].
+            Parents have to be listed before their children.
+        """
+        self.names = []
+        self.parents = {}
+        self.cpts = {}
+        for node in nodes:
+            name = node["name"]
+            parents = list(node.get("parents", []))
+            for parent in parents:
+                if parent not in self.parents:
+                    raise ValueError(f"parent {parent} of {name} has to be listed before it")
+            cpt = np.asarray(node["cpt"], dtype=float)
+            if cpt.shape != (2,) * len(parents):
+                raise ValueError(f"cpt of {name} has shape {cpt.shape}, expected {(2,) * len(parents)}")
+            self.names.append(name)
+            self.parents[name] = parents
+            self.cpts[name] = cpt
+        self._assignments = None
+        self._joint = None
+
+    @classmethod
+    def from_dict(cls, spec):
+        """
+        Build a net from {"nodes": [...]} (see __init__ for the node format)
+        """
+        return cls(spec["nodes"])
+
+    @classmethod
+    def from_json(cls, path):
+        """
+        Build a net from a json file holding the same structure as from_dict
+        """
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self):
+        return {"nodes": [{"name": name, "parents": self.parents[name], "cpt": self.cpts[name].tolist()} for name in self.names]}
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def invalidate(self):
+        """
+        Mark the joint table as stale so it is rebuilt from the CPTs on the next exact query. This has to be called
+        whenever a cpt changes.
+        """
+        self._joint = None
+
+    @property
+    def assignments(self):
+        """
+        (2^n x n) array of every assignment of the net, in itertools.product order
+        """
+        if self._assignments is None:
+            n = len(self.names)
+            self._assignments = (np.arange(2 ** n, dtype=np.intp)[:, None] >> np.arange(n - 1, -1, -1)) & 1
+        return self._assignments
+
+    @property
+    def joint(self):
+        """
+        Joint probability of every row of self.assignments
+        """
+        if self._joint is None:
+            assignments = self.assignments
+            joint = np.ones(len(assignments))
+            for i, name in enumerate(self.names):
+                p_one = self.p_one(name, assignments)
+                joint *= np.where(assignments[:, i] == 1, p_one, 1 - p_one)
+            self._joint = joint
+        return self._joint
+
+    def p_one(self, name, values):
+        """
+        P(name = 1 | parents) for every row of values (an array of assignments with columns in self.names order)
+        """
+        parent_cols = [self.index(parent) for parent in self.parents[name]]
+        return self.cpts[name][tuple(values[:, parent_cols].T)]
+
+    def check_observation(self, observation):
+        """
+        Raise a ValueError unless observation is a {node: 0 or 1} dict over nodes of the net, so a misspelled node
+        can't be silently ignored
+        """
+        for key, value in observation.items():
+            if key not in self.parents:
+                raise ValueError(f"unknown node {key} in observation, expected one of {self.names}")
+            if value not in (0, 1):
+                raise ValueError(f"observed value of {key} must be 0 or 1, got {value}")
+
+    def evidence_array(self, observations):
+        """
+        Turn a list of {node: 0 or 1} dicts into an (n_obs, n_nodes) int array with -1 for unobserved nodes
+        """
+        if isinstance(observations, np.ndarray):
+            return observations.astype(np.intp)
+        evidence = np.full((len(observations), len(self.names)), -1, dtype=np.intp)
+        for row, observation in enumerate(observations):
+            self.check_observation(observation)
+            for key, value in observation.items():
+                evidence[row, self.index(key)] = value
+        return evidence
+
+    def query(self, observation, target="busy"):
+        """
+        Exact P(target = 1 | observation)
+
+        Parameters:
+        observation: dict
+            {node: 0 or 1} for any of the nodes of the net
+        target: string
+            name of the node to query
+        """
+        return float(self.query_many([observation], target)[0])
+
+    def query_many(self, observations, target="busy", chunk_size=4096):
+        """
+        Exact P(target = 1 | observation) for many observations in one vectorized pass
+
+        Parameters:
+        observations: list or numpy array
+            list of {node: 0 or 1} dicts, or an (n_obs, n_nodes) array with -1 for unobserved nodes
+        target: string
+            name of the node to query
+        chunk_size: int
+            number of distinct observations matched against the joint table at a time
+        """
+        evidence = self.evidence_array(observations)
+        # many users share the same evidence, so only the distinct rows are solved
+        unique, inverse = np.unique(evidence, axis=0, return_inverse=True)
+        target_joint = self.joint * (self.assignments[:, self.index(target)] == 1)
+
+        probs = np.empty(len(unique))
+        for start in range(0, len(unique), chunk_size):
+            rows = unique[start:start + chunk_size]
+            match = ((rows[:, None, :] == self.assignments[None, :, :]) | (rows[:, None, :] < 0)).all(axis=2)
+            evidence_prob = match @ self.joint
+            if np.any(evidence_prob == 0):
+                raise ValueError("an observation has zero probability")
+            probs[start:start + chunk_size] = (match @ target_joint) / evidence_prob
+        return probs[inverse.reshape(-1)]
+
+    def likelihood_weighting(self, observation, target="busy", n_samples=100000, seed=None, batch_size=50000):
+        """
+        Estimate P(target = 1 | observation) with a vectorized likelihood weighting sampler.
+        Observed nodes are clamped to their values and each sample is weighted by the likelihood of the evidence,
+        so no samples are thrown away.
+
+        Parameters:
+        observation: dict
+            {node: 0 or 1} for any of the nodes of the net
+        target: string
+            name of the node to query
+        n_samples: int
+            total number of samples to draw
+        seed: int or None
+            seed for the random number generator
+        batch_size: int
+            number of samples drawn per numpy pass (bounds the memory used)
+
+        Returns a dict with the estimate "prob", the effective sample size "ess" and "n_samples".
+        """
+        self.check_observation(observation)
+        if n_samples <= 0:
+            raise ValueError(f"n_samples must be positive, got {n_samples}")
+        rng = np.random.default_rng(seed)
+        target_col = self.index(target)
+        total_w = 0.0
+        total_w_sq = 0.0
+        total_w_target = 0.0
+
+        drawn = 0
+        while drawn < n_samples:
+            size = min(batch_size, n_samples - drawn)
+            values, weights = self.weighted_samples(observation, size, rng)
+            total_w += np.sum(weights)
+            total_w_sq += np.sum(weights ** 2)
+            total_w_target += np.sum(weights * values[:, target_col])
+            drawn += size
+
+        if total_w == 0:
+            raise ValueError(f"observation {observation} has zero probability")
+        return {"prob": float(total_w_target / total_w), "ess": float(total_w ** 2 / total_w_sq), "n_samples": drawn}
+
+    def weighted_samples(self, observation, size, rng):
+        """
+        Draw size likelihood weighted samples in one numpy pass. Returns the (size x nodes) values and the weights.
+        """
+        values = np.zeros((size, len(self.names)), dtype=np.intp)
+        weights = np.ones(size)
+        for i, name in enumerate(self.names):
+            p_one = self.p_one(name, values)
+            if name in observation:
+                # clamp observed nodes and weight by their likelihood
+                values[:, i] = observation[name]
+                weights *= np.where(values[:, i] == 1, p_one, 1 - p_one)
+            else:
+                values[:, i] = rng.random(size) < p_one
+        return values, weights
+
+    def likelihood_weighting_to_precision(self, observation, target="busy", target_se=None, rtol=None, max_time=None,
+                                          max_samples=10**6, seed=None, batch_size=10000):
+        """
+        Likelihood weighting that draws batches until P(target = 1 | observation) has the requested standard error
+        (see precision.run_until_precision), so easy queries stop early and hard ones get a known precision.
+
+        Parameters:
+        observation: dict
+            {node: 0 or 1} for any of the nodes of the net
+        target: string
+            name of the node to query
+        target_se, rtol: float or None
+            absolute and relative standard error to reach
+        max_time: float or None
+            time budget in seconds
+        max_samples: int
+            sample budget
+        seed: int or None
+            seed for the random number generator
+        batch_size: int
+            size of the first batch
+
+        Returns a dict with the estimate "prob", its standard error "se", "ess", "n_samples", "elapsed", "converged"
+        and the stop "reason".
+        """
+        self.check_observation(observation)
+        if max_samples <= 0:
+            raise ValueError(f"max_samples must be positive, got {max_samples}")
+        rng = np.random.default_rng(seed)
+        target_col = self.index(target)
+
+        def draw(size):
+            values, weights = self.weighted_samples(observation, size, rng)
+            return values[:, target_col], weights
+
+        try:
+            result = precision.run_until_precision(draw, target_se, rtol, max_time, max_samples, batch_size, name="busy")
+        except ValueError:
+            raise ValueError(f"observation {observation} has zero probability")
+        return {"prob": result.pop("estimate"), **result}
+
+
+class CPTLearner:
+    def __init__(self, net, prior_strength=10.0):
+        """
+        Incrementally learn the CPTs of a net from a stream of observations.
+        Every CPT cell keeps counts of how often the node was 0 and 1 for that parent assignment, and the net is
+        updated in place after every record, so queries on self.net always reflect the current counts.
+
+        Parameters:
+        net: BayesNet
+            net whose CPTs are learned. Its current CPTs are used as the prior.
+        prior_strength: float
+            number of pseudo-observations the prior CPTs are worth in every cell
+        """
+        self.net = net
+        self.n_records = 0
+        self.counts = {}
+        # cell of every joint assignment in each node's count table, used to spread soft counts. Built with the
+        # joint table on the first partially observed record, fully observed streams never need either.
+        self.cells = None
+        for name in net.names:
+            cpt = net.cpts[name]
+            self.counts[name] = np.stack([1 - cpt, cpt], axis=-1) * prior_strength
+
+    def build_cells(self):
+        if self.cells is None:
+            self.cells = {}
+            for i, name in enumerate(self.net.names):
+                cols = [self.net.index(parent) for parent in self.net.parents[name]] + [i]
+                self.cells[name] = np.ravel_multi_index(tuple(self.net.assignments[:, cols].T), self.counts[name].shape)
+        return self.cells
+
+    def update(self, record):
+        """
+        Fold one observation into the counts. Nodes missing from the record (e.g. rain and event in the visit logs)
+        get expected counts from their posterior under the current CPTs, so the cost per record does not grow with
+        the length of the stream.
+
+        Parameters:
+        record: dict
+            {node: 0 or 1}, e.g. {"wind": 1, "cloudy": 0, "exams": 0, "academic_holiday": 1, "busy": 1}
+        """
+        self.net.check_observation(record)
+        if len(record) == len(self.net.names):
+            for name in self.net.names:
+                cell = tuple(record[parent] for parent in self.net.parents[name]) + (record[name],)
+                self.counts[name][cell] += 1
+        else:
+            match = np.ones(len(self.net.joint), dtype=bool)
+            for key, value in record.items():
+                match &= self.net.assignments[:, self.net.index(key)] == value
+            posterior = self.net.joint * match
+            total = np.sum(posterior)
+            if total == 0:
+                raise ValueError(f"record {record} has zero probability under the current CPTs")
+            posterior /= total
+            cells = self.build_cells()
+            for name in self.net.names:
+                counts = self.counts[name]
+                counts += np.bincount(cells[name], weights=posterior, minlength=counts.size).reshape(counts.shape)
+
+        self.n_records += 1
+        self.refresh()
+
+    def update_many(self, records):
+        """
+        Fold a batch of observations into the counts, one record at a time
+        """
+        for record in records:
+            self.update(record)
+
+    def refresh(self):
+        """
+        Write the current count estimates into the net's CPTs and invalidate its joint table
+        """
+        for name, counts in self.counts.items():
+            total = counts.sum(axis=-1)
+            self.net.cpts[name] = np.where(total > 0, counts[..., 1] / np.where(total > 0, total, 1), self.net.cpts[name])
+        self.net.invalidate()
+
+    def save(self, path):
+        """
+        Checkpoint the counts to an .npz file
+        """
+        np.savez(path, n_records=self.n_records, **{f"counts_{name}": counts for name, counts in self.counts.items()})
+
+    def restore(self, path):
+        """
+        Restore counts saved with save() and update the net to match them
+        """
+        with np.load(path) as saved:
+            for name in self.net.names:
+                counts = saved[f"counts_{name}"]
+                if counts.shape != self.counts[name].shape:
+                    raise ValueError(f"saved counts for {name} have shape {counts.shape}, expected {self.counts[name].shape}")
+                self.counts[name] = counts.astype(float)
+            self.n_records = int(saved["n_records"])
+        self.refresh()
@@ -0,0 +1,261 @@
+import io
+import os
+import sys
+import json
+import subprocess
+import contextlib
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+import busyBayes
+import fruitYield
+import simulateWeatherData
+import simulateLocationPref as loc_file
+import recommenderSystem as rec_file
+import treeRegistry
+from campusMap import CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, TREE_COUNTS, SEASONS
+
+SEED = 0
+OBSERVATION = {"wind": 1, "cloudy": 0, "exams": 1, "academic_holiday": 0}
+
+# entry points that have to start fast, the most their import may take and the packages they must not pull in
+STARTUP_MODULES = ["gui", "service", "busyBayes", "fruitYield", "recommenderSystem", "simulateLocationPref"]
+IMPORT_TIME_TARGET = 0.5
+HEAVY_MODULES = ["matplotlib", "pandas", "scipy", "colorama"]
+
+
+def campus(n_locs):
+    """
+    Synthetic campus with n_locs unit-square locations laid out on a grid, in the same format as the gui constants
+    """
+    n_rows = int(np.floor(np.sqrt(n_locs)))
+    n_cols = int(np.ceil(n_locs / n_rows))
+    map_dict, map_locs = {}, {}
+    for i in range(n_locs):
+        x, y = i % n_cols, i // n_cols
+        map_dict[f"loc{i}"] = [x + 0.5, y + 0.5]
+        map_locs[f"loc{i}"] = [(x, x + 1), (y, y + 1)]
+    return (0, n_cols, 0, n_rows), map_dict, map_locs
+
+
+# each benchmark maps its parameters to a zero-argument function running the hot path once
+
+def bench_prob_busy(method, n_samples):
+    if method == "exact":
+        return lambda: busyBayes.prob_busy(OBSERVATION)
+    if method == "adaptive":
+        # n_samples is the budget, the run stops once the standard error is 1% of the estimate
+        return lambda: busyBayes.prob_busy(OBSERVATION, method="adaptive", rtol=0.01, max_samples=n_samples, seed=SEED)
+    return lambda: busyBayes.prob_busy(OBSERVATION, method="sampling", n_samples=n_samples, seed=SEED)
+
+
+def bench_frootstrap(n_years, iterations):
+    store = fruitYield.X if n_years == 0 else simulateWeatherData.simulate_history(n_years, seed=SEED)
+    fruitYield.analogIndex(store)
+    return lambda: fruitYield.frootstrap(store, 1.51, 60, iterations, seed=SEED)
+
+
+def bench_create_pref_pdf(grid_size):
+    def run():
+        # a new object every run so the kernel and pdf caches start cold
+        pref = loc_file.LocationPref(CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, grid_size=grid_size)
+        return pref.create_pref_pdf(["med", "memchu"])
+    return run
+
+
+def bench_probability_locs(n_locs, mode):
+    bounds, map_dict, map_locs = campus(n_locs)
+    pref = loc_file.LocationPref(bounds, map_dict, map_locs, grid_size=500, mode=mode)
+    prefs = list(map_dict)[:3]
+    if mode == "analytic":
+        return lambda: pref.analytic_probability_regions(prefs)
+    pdf = pref.create_pref_pdf(prefs)
+    return lambda: pref.probability_regions(pdf)
+
+
+def bench_simulate_picked(days, replicates):
+    rec_obj = rec_file.RecommendTrees(None, TREE_COUNTS, SEASONS, seed=SEED)
+    return lambda: rec_obj.simulate_expected_fruit_picked("orange", days, replicates)
+
+
+def bench_recommend_location():
+    pref = loc_file.LocationPref(CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, mode="analytic")
+    prob_locs = pref.pref_probability_locs(["med", "ev"])
+
+    def run():
+        fruitYield.YIELD_CACHE.clear()
+        rec_obj = rec_file.RecommendTrees(prob_locs, TREE_COUNTS, SEASONS, seed=SEED)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return rec_obj.recommend_location(CAMPUS_BOUNDS, STANFORD_MAP_LOCS, "orange", None, 1.51, 60)
+    return run
+
+
+def bench_recommend_trees(n_trees):
+    rng = np.random.default_rng(SEED)
+    regions = rng.choice(list(STANFORD_MAP_LOCS), size=n_trees)
+    coords = np.array([STANFORD_MAP_DICT[region] for region in regions]) + rng.uniform(-0.5, 0.5, size=(n_trees, 2))
+    trees = treeRegistry.TreeRegistry(np.arange(n_trees), rng.choice(list(SEASONS), size=n_trees), coords[:, 0], coords[:, 1], regions,
+                                      region_names=list(STANFORD_MAP_LOCS))
+    pref = loc_file.LocationPref(CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, mode="analytic")
+    probs = dict(zip(pref.region_names, pref.analytic_probability_regions(["med"])))
+    rec_obj = rec_file.RecommendTrees(probs, None, SEASONS, seed=SEED, trees=trees)
+    return lambda: rec_obj.recommend_trees("orange", 1.51, 60, user_location=(2.5, 0.5), radius=1.0, k=10)
+
+
+def bench_recommend_many(n_users):
+    user_probs = np.random.default_rng(SEED).dirichlet(np.ones(len(TREE_COUNTS)), size=n_users)
+    rec_obj = rec_file.RecommendTrees(None, TREE_COUNTS, SEASONS, seed=SEED)
+    return lambda: rec_obj.recommend_many(user_probs, "orange", 1.51, 60, k=3)
+
+
+# name, benchmark function and the parameter sweep (full, quick)
+BENCHMARKS = [
+    ("prob_busy", bench_prob_busy,
+     [{"method": "exact", "n_samples": 0}] + [{"method": "sampling", "n_samples": n} for n in (10**3, 10**4, 10**5, 10**6)]
+     + [{"method": "adaptive", "n_samples": 10**6}],
+     [{"method": "exact", "n_samples": 0}, {"method": "sampling", "n_samples": 10**4}, {"method": "adaptive", "n_samples": 10**6}]),
+    ("frootstrap", bench_frootstrap,
+     [{"n_years": y, "iterations": i} for y in (0, 10**3, 10**4) for i in (10**3, 10**4)],
+     [{"n_years": 0, "iterations": 10**4}]),
+    ("create_pref_pdf", bench_create_pref_pdf,
+     [{"grid_size": g} for g in (100, 500, 1000, 2000)],
+     [{"grid_size": 100}]),
+    ("probability_locs", bench_probability_locs,
+     [{"n_locs": n, "mode": m} for n in (6, 60, 600) for m in ("grid", "analytic")],
+     [{"n_locs": 6, "mode": "grid"}, {"n_locs": 6, "mode": "analytic"}]),
+    ("simulate_expected_fruit_picked", bench_simulate_picked,
+     [{"days": d, "replicates": r} for d in (30, 365) for r in (1, 100)],
+     [{"days": 30, "replicates": 1}]),
+    ("recommend_location", bench_recommend_location, [{}], [{}]),
+    ("recommend_trees", bench_recommend_trees,
+     [{"n_trees": n} for n in (10**3, 10**4, 10**5)],
+     [{"n_trees": 10**3}]),
+    ("recommend_many", bench_recommend_many,
+     [{"n_users": n} for n in (10**3, 10**5, 10**6)],
+     [{"n_users": 10**3}]),
+]
+
+
+def measure(run, repeats):
+    """
+    Median wall time over repeats runs, and the peak traced memory of one extra run
+    """
+    run()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": float(np.median(times)), "peak_bytes": int(peak)}
+
+
+def import_time(module, repeats=5):
+    """
+    Fastest cumulative import time of module over repeats fresh interpreters (from -X importtime), and the heavy
+    packages the import loaded
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    times, heavy = [], []
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=here, capture_output=True,
+                              text=True, check=True)
+        for line in proc.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                times.append(int(fields[1]) / 1e6)
+        heavy = [m for m in proc.stdout.strip().split(",") if m]
+    return min(times), heavy
+
+
+def check_import_time(modules=STARTUP_MODULES, target=IMPORT_TIME_TARGET, repeats=5):
+    """
+    Failures of the startup budget: modules importing slower than target seconds or loading a heavy package
+    """
+    failures = []
+    for module in modules:
+        seconds, heavy = import_time(module, repeats)
+        print(f"import {module:<64} {seconds * 1000:10.3f} ms {','.join(heavy)}")
+        if seconds > target:
+            failures.append(f"import {module}: {seconds:.3f} s over the {target} s target")
+        if heavy:
+            failures.append(f"import {module}: loads {', '.join(heavy)}")
+    return failures
+
+
+def case_name(name, params):
+    return name + "".join(f"[{key}={value}]" for key, value in params.items())
+
+
+def run_benchmarks(quick=False, repeats=5, only=None):
+    """
+    Run the benchmark sweeps and return {case name: {"seconds", "peak_bytes"}}
+    """
+    results = {}
+    for name, bench, full, short in BENCHMARKS:
+        if only is not None and name not in only:
+            continue
+        for params in (short if quick else full):
+            case = case_name(name, params)
+            results[case] = measure(bench(**params), repeats)
+            print(f"{case:<70} {results[case]['seconds'] * 1000:10.3f} ms {results[case]['peak_bytes'] / 2**20:10.2f} MiB")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Cases whose time or peak memory grew by more than threshold (a fraction) over the baseline
+    """
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            old, new = baseline[case][metric], result[metric]
+            if old > 0 and new > old * (1 + threshold):
+                regressions.append(f"{case} {metric}: {old:.6g} -> {new:.6g} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark BirdFeeder's hot paths.")
+    parser.add_argument("--quick", action="store_true", help="run one small case per benchmark")
+    parser.add_argument("--repeats", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--only", nargs="+", default=None, help="names of the benchmarks to run")
+    parser.add_argument("--save", default=None, help="write the results to this json file")
+    parser.add_argument("--baseline", default=None, help="compare against results saved with --save")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed growth over the baseline, as a fraction")
+    parser.add_argument("--check-import-time", action="store_true",
+                        help="only check that the entry points import in under --import-target seconds without heavy packages")
+    parser.add_argument("--import-target", type=float, default=IMPORT_TIME_TARGET, help="import time budget in seconds")
+    args = parser.parse_args(argv)
+
+    if args.check_import_time:
+        failures = check_import_time(target=args.import_target)
+        for failure in failures:
+            print(f"SLOW STARTUP {failure}")
+        return 1 if failures else 0
+
+    results = run_benchmarks(args.quick, args.repeats, args.only)
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,64 +1,124 @@
-import numpy as np
-import scipy.stats as stats
+from bayesNet import BayesNet, CPTLearner
+import instrumentation as inst
 
 N_SAMPLES = 100000
+BATCH_SIZE = 50000
+
+# structure and CPTs of the busyness network. Each cpt holds P(node = 1 | parents), indexed by the parent values
+# in the order the parents are listed, and parents always come before their children.
+BUSY_MODEL = {
+    "nodes": [
+        {"name": "cloudy", "parents": [], "cpt": 0.4},
+        {"name": "wind", "parents": [], "cpt": 0.8},
+        {"name": "exams", "parents": [], "cpt": 0.076},
+        {"name": "academic_holiday", "parents": [], "cpt": 0.26},
+        # cpt[wind][cloudy]
+        {"name": "rain", "parents": ["wind", "cloudy"], "cpt": [[0.1, 0.4], [0.4, 0.8]]},
+        # cpt[exams]
+        {"name": "event", "parents": ["exams"], "cpt": [0.7, 0.02]},
+        # cpt[rain][event][academic_holiday]
+        {"name": "busy", "parents": ["rain", "event", "academic_holiday"],
+         "cpt": [[[0.7, 0.55], [0.65, 0.4]], [[0.2, 0.015], [0.01, 0.01]]]},
+    ]
+}
+
+NET = BayesNet.from_dict(BUSY_MODEL)
+NODES = NET.names
 
 def p_rain(wind, cloudy):
     # P(rain = 1 | wind = wind, cloudy = cloudy)
-    if wind == 1 and cloudy == 1: return 0.8
-    if wind == 1 and cloudy == 0: return 0.4
-    if wind == 0 and cloudy == 1: return 0.4
-    if wind == 0 and cloudy == 0: return 0.1
+    return NET.cpts["rain"][wind, cloudy]
 
 def p_event(exams):
     # P(event = 1 | exams = exams)
-    if exams == 1: return 0.02
-    if exams == 0: return 0.7
+    return NET.cpts["event"][exams]
 
 def p_busy(rain, event, academic_holiday):
     # P(busy = 1 | rain = rain, event = event, academic_holiday = academic_holiday)
-    if academic_holiday == 0:
-        if rain == 1 and event == 1: return 0.01
-        if rain == 1 and event == 0: return 0.2
-        if rain == 0 and event == 1: return 0.65
-        if rain == 0 and event == 0: return 0.7
-    else:
-        if rain == 1 and event == 1: return 0.01
-        if rain == 1 and event == 0: return 0.015
-        if rain == 0 and event == 1: return 0.4
-        if rain == 0 and event == 0: return 0.55
-
-def bernoulli(p):
-    return stats.bernoulli.rvs(p)
-
-def prob_busy(observation):
-    # make a sample
-    def sampling():
-        cloudy = bernoulli(0.4)
-        wind = bernoulli(0.8)
-        exams = bernoulli(0.076)
-        academic_holiday = bernoulli(0.26)
-
-        rain = bernoulli(p_rain(wind, cloudy))
-        event = bernoulli(p_event(exams))
-
-        busy = bernoulli(p_busy(rain, event, academic_holiday))
-        
-        return {"cloudy":cloudy, "wind":wind, "exams":exams, "academic_holiday":academic_holiday, "rain":rain, "event":event, "busy":busy}
-    
-    def obs_match(output, obs):
-        for key in obs.keys():
-            if obs[key] != output[key]:
-                return False
-        return True
-    
-    samples = []
-    busy = 0
-    for iters in range(100000):
-        sample = sampling()
-        if obs_match(sample, observation):
-            samples.append(sample)
-            if sample["busy"] == 1:
-                busy += 1
-    
-    return busy/len(samples)
+    return NET.cpts["busy"][rain, event, academic_holiday]
+
+def exact_prob_busy(observation, net=NET):
+    """
+    P(busy = 1 | observation) by enumerating the full joint distribution (no sampling noise).
+
+    Parameters:
+    observation: dict
+        {node: 0 or 1} for any of the nodes in NODES
+    net: BayesNet
+        network to query
+    """
+    return net.query(observation, "busy")
+
+def likelihood_weighting(observation, n_samples=N_SAMPLES, seed=None, batch_size=BATCH_SIZE, net=NET):
+    """
+    Estimate P(busy = 1 | observation) with the vectorized likelihood weighting sampler of the network.
+    Returns a dict with the estimate "prob", the effective sample size "ess" and "n_samples".
+    """
+    return net.likelihood_weighting(observation, "busy", n_samples=n_samples, seed=seed, batch_size=batch_size)
+
+def likelihood_weighting_to_precision(observation, target_se=None, rtol=None, max_time=None, max_samples=10 * N_SAMPLES,
+                                      seed=None, net=NET):
+    """
+    Estimate P(busy = 1 | observation) by likelihood weighting until the standard error reaches target_se and/or
+    rtol * estimate, or max_time seconds or max_samples samples are used up.
+    Returns a dict with "prob", its standard error "se", "ess", "n_samples", "elapsed", "converged" and "reason".
+    """
+    return net.likelihood_weighting_to_precision(observation, "busy", target_se, rtol, max_time, max_samples, seed)
+
+def prob_busy(observation, method="exact", net=NET, **sampler_args):
+    """
+    Probability that the tree is busy given the observation.
+
+    Parameters:
+    observation: dict
+        {node: 0 or 1}, e.g. {"wind": 1, "cloudy": 0, "exams": 0, "academic_holiday": 1}
+    method: string
+        "exact" to enumerate the network, "sampling" for the likelihood weighting sampler with a fixed number of
+        samples, "adaptive" to sample until a requested precision
+    net: BayesNet
+        network to query
+    sampler_args:
+        n_samples, seed and batch_size passed on to likelihood_weighting when sampling, target_se, rtol, max_time,
+        max_samples and seed passed on to likelihood_weighting_to_precision when adaptive
+    """
+    if method == "exact":
+        with inst.span("busy.exact"):
+            return exact_prob_busy(observation, net)
+    if method == "sampling":
+        with inst.span("busy.sampling"):
+            result = likelihood_weighting(observation, net=net, **sampler_args)
+        # with likelihood weighting the effective sample size plays the role of the accepted samples
+        inst.count("busy.samples_drawn", result["n_samples"])
+        inst.count("busy.effective_samples", result["ess"])
+        inst.gauge("busy.acceptance_rate", result["ess"] / result["n_samples"])
+        return result["prob"]
+    if method == "adaptive":
+        with inst.span("busy.adaptive"):
+            result = likelihood_weighting_to_precision(observation, net=net, **sampler_args)
+        inst.count("busy.effective_samples", result["ess"])
+        inst.gauge("busy.acceptance_rate", result["ess"] / result["n_samples"])
+        return result["prob"]
+    raise ValueError(f"unknown method {method}")
+
+def prob_busy_many(observations, net=NET):
+    """
+    Exact probability that the tree is busy for many observations at once.
+
+    Parameters:
+    observations: list
+        list of {node: 0 or 1} dicts, e.g. one per user
+    net: BayesNet
+        network to query
+    """
+    return net.query_many(observations, "busy")
+
+def busy_learner(prior_strength=10.0):
+    """
+    Start a CPTLearner on a fresh copy of the busyness network, using the hand-set CPTs as the prior.
+    Pass learner.net to prob_busy to query the learned probabilities.
+
+    Parameters:
+    prior_strength: float
+        number of pseudo-observations the hand-set CPTs are worth in every cell
+    """
+    return CPTLearner(BayesNet.from_dict(BUSY_MODEL), prior_strength)
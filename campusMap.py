@@ -0,0 +1,9 @@
+# campus map, tree locations and fruit seasons shared by the cli, the service and the offline tools
+CAMPUS_BOUNDS = (0, 3, 0, 2)
+STANFORD_MAP_DICT = {"ev": [0.5, 1.5], "gsb": [0.5, 0.5], "memchu": [1.5, 0.5], "tressider": [1.5, 1.5], "med": [2.5, 0.5], "engg": [2.5, 1.5]}
+STANFORD_MAP_LOCS = {"ev": [(0, 1), (1, 2)], "gsb": [(0, 1), (0, 1)], "memchu": [(1, 2), (0, 1)], "tressider": [(1, 2), (1, 2)], "med": [(2, 3), (0, 1)], "engg": [(2, 3), (1, 2)]}
+STANFORD_COORD_LOCS = {(0, 1): "ev", (0, 0): "gsb", (1, 0): "memchu", (1, 1): "tressider", (2, 0): "med", (2, 1): "engg"}
+TREE_COUNTS =  {"ev": {"orange": 1, "pomegranate": 1}, "gsb": {"orange": 0, "pomegranate": 0}, "memchu": {"orange": 2, "pomegranate": 0}, "tressider": {"orange": 0, "pomegranate": 0}, "med": {"orange": 1, "pomegranate": 0}, "engg": {"orange": 0, "pomegranate": 1}}
+SEASONS = {"orange": ["december", "january", "february"], "pomegranate": ["october", "november", "december"]}
+DEFAULT_AVG_TEMP = 60
+DEFAULT_AVG_RAIN = 1.51
@@ -1,10 +1,33 @@
+import weakref
+from collections import OrderedDict
 import numpy as np
-import random
-import json
 
-with open('weatherData.json', 'r') as f:
-    X = json.load(f)
-# print(X)
+import weatherStore
+import precision
+import instrumentation as inst
+
+# memory ceiling for one chunk of bootstrap resample indices
+MAX_BOOTSTRAP_BYTES = 64 * 2**20
+
+# half-widths of the window of past years considered similar to this year's (rain, temp)
+RAIN_WINDOW = 0.8
+TEMP_WINDOW = 3
+
+# analog year index of every store, built the first time the store is queried
+_INDEXES = weakref.WeakKeyDictionary()
+
+def __getattr__(name):
+    # X is the shared store for the configured weather data (weatherStore.DATA_PATH), looked up on access so the
+    # path can be set after import; the arrays are only read the first time they are used
+    if name == "X":
+        return weatherStore.get_store()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def as_store(data):
+    # accept either a WeatherStore or data in the weatherData.json layout
+    if isinstance(data, weatherStore.WeatherStore):
+        return data
+    return weatherStore.WeatherStore.from_dict(data)
 
 def averageRain(data, year):
     averageRain = 0
@@ -18,49 +41,228 @@ def averageTemp(data, year):
         averageTemp += (np.sum(data[year][1][value]) / 12)
     return averageTemp
 
-def fruitYield(data, latestWeather):
+class AnalogYearIndex:
+    def __init__(self, avgRain, avgTemp, rainScale=RAIN_WINDOW, tempScale=TEMP_WINDOW):
+        """
+        KD-tree over the (average rain, average temp) of every year, so the years inside a weather window
+        are found without scanning the whole history.
+
+        Parameters:
+        avgRain, avgTemp: numpy arrays
+            average rain and temp of every year
+        rainScale, tempScale: float
+            the coordinates are divided by these so a typical window is a unit square in the tree
+        """
+        self.avgRain = np.asarray(avgRain, dtype=float)
+        self.avgTemp = np.asarray(avgTemp, dtype=float)
+        self.rainScale = rainScale
+        self.tempScale = tempScale
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(np.column_stack([self.avgRain / rainScale, self.avgTemp / tempScale]))
+
+    def query(self, rain, temp, rainWindow=RAIN_WINDOW, tempWindow=TEMP_WINDOW):
+        """
+        Indices (in year order) of the years with |avg rain - rain| < rainWindow and |avg temp - temp| < tempWindow
+        """
+        # the tree returns the (slightly larger) square around the point, the strict window test is applied after
+        radius = max(rainWindow / self.rainScale, tempWindow / self.tempScale) * (1 + 1e-9)
+        candidates = np.array(sorted(self.tree.query_ball_point([rain / self.rainScale, temp / self.tempScale], radius, p=np.inf)), dtype=np.intp)
+        if len(candidates) == 0:
+            return candidates
+        keep = (np.abs(rain - self.avgRain[candidates]) < rainWindow) & (np.abs(temp - self.avgTemp[candidates]) < tempWindow)
+        return candidates[keep]
+
+def analogIndex(store):
+    # index of the annual summaries of a store, built once per store
+    if store not in _INDEXES:
+        _INDEXES[store] = AnalogYearIndex(*store.annual_summary())
+    return _INDEXES[store]
+
+def analogYears(data, latestWeather, rainWindow=RAIN_WINDOW, tempWindow=TEMP_WINDOW):
+    # indices of the past years whose average rain and temp are close to latestWeather = (rain, temp)
+    return analogIndex(as_store(data)).query(latestWeather[0], latestWeather[1], rainWindow, tempWindow)
+
+def fruitYields(data, latestWeather, fruits=None, rainWindow=RAIN_WINDOW, tempWindow=TEMP_WINDOW):
+    # latestWeather is a tuple of this year's weather: (rain, temp).
+    # returns {fruit: array of yields of the past years with similar weather} for every fruit in fruits (default: all in the store)
+    store = as_store(data)
+    with inst.span("yield.analog_years"):
+        match = analogYears(store, latestWeather, rainWindow, tempWindow)
+    inst.count("yield.analog_queries")
+    inst.count("yield.analog_years_matched", len(match))
+    inst.gauge("yield.analog_years_last", len(match))
+    return {fruit: np.asarray(store.yields[fruit])[match] for fruit in (fruits if fruits is not None else store.fruits)}
+
+def fruitYield(data, latestWeather, rainWindow=RAIN_WINDOW, tempWindow=TEMP_WINDOW):
     # latestWeather is a tuple of this year's weather: (rain, temp).
-    # come up w rain and temp avg values for this past year
-    fruit = 0
-    pomegranateCountList = []
-    orangeCountList = []
-    for year in data:
-        rain = averageRain(data, year)
-        temp = averageTemp(data, year)
-        # print(rain, temp)
-        if abs(latestWeather[0] - rain) < 0.8:
-            if abs(latestWeather[1] - temp) < 3:
-                pomegranateCountList.append(data[year][3]["pomegranates"])
-                orangeCountList.append(data[year][2]["oranges"])
-                # print(year)
-    # if len(pomegranateCountList) > 0:
-    #     print(np.mean(pomegranateCountList), pomegranateCountList)
-    return (pomegranateCountList, orangeCountList)
-
-def frootstrap(data, avgRain, avgTemp, numIterations):
+    # returns the pomegranate and orange yields of the past years with similar weather
+    counts = fruitYields(data, latestWeather, ["pomegranate", "orange"], rainWindow, tempWindow)
+    return (counts["pomegranate"].tolist(), counts["orange"].tolist())
+
+def bootstrapResamples(values, numIterations, rng, maxBytes=MAX_BOOTSTRAP_BYTES):
+    # (n_rows, numIterations) means of numIterations resamples of the columns of values, all rows sharing the
+    # same indices, drawn in chunks of at most maxBytes
+    nRows, n = values.shape
+    chunkIterations = max(1, maxBytes // (n * (np.dtype(np.intp).itemsize + nRows * values.itemsize)))
+    resampleMeans = np.empty((nRows, numIterations))
+    for start in range(0, numIterations, chunkIterations):
+        size = min(chunkIterations, numIterations - start)
+        indices = rng.integers(0, n, size=(size, n))
+        resampleMeans[:, start:start + size] = np.mean(values[:, indices], axis=2)
+    inst.count("yield.bootstrap_resamples", numIterations)
+    inst.count("yield.bootstrap_draws", numIterations * n)
+    return resampleMeans
+
+def bootstrapMeans(values, numIterations, maxBytes=MAX_BOOTSTRAP_BYTES, confidence=0.95, seed=None):
+    """
+    Bootstrap the means of several rows of values that share the same resample indices.
+    All resamples of a chunk are drawn as one (iterations x n) index matrix.
+
+    Parameters:
+    values: numpy array
+        (n_rows, n) observed values to resample, e.g. one row per fruit over the same years
+    numIterations: int
+        number of bootstrap resamples
+    maxBytes: int
+        upper bound on the memory used by one chunk of resample indices and resampled values
+    confidence: float
+        coverage of the percentile confidence interval
+    seed: int or None
+        seed for the random number generator
+
+    Returns a list with one dict per row holding the bootstrap "mean", its standard error "se" and the
+    confidence interval "ci" as (low, high).
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    nRows, n = values.shape
+    if n == 0:
+        raise ValueError("cannot bootstrap from an empty list of yields")
+    rng = np.random.default_rng(seed)
+    with inst.span("yield.bootstrap"):
+        resampleMeans = bootstrapResamples(values, numIterations, rng, maxBytes)
+
+    alpha = (1 - confidence) / 2
+    lows, highs = np.quantile(resampleMeans, [alpha, 1 - alpha], axis=1)
+    means = np.mean(resampleMeans, axis=1)
+    ses = np.std(resampleMeans, axis=1, ddof=1) if numIterations > 1 else np.zeros(nRows)
+    return [{"mean": float(means[i]), "se": float(ses[i]), "ci": (float(lows[i]), float(highs[i]))} for i in range(nRows)]
+
+def bootstrapMean(values, numIterations, maxBytes=MAX_BOOTSTRAP_BYTES, confidence=0.95, seed=None):
+    # bootstrapMeans for a single list of values
+    return bootstrapMeans(np.asarray(values, dtype=float)[None, :], numIterations, maxBytes, confidence, seed)[0]
+
+def frootstrapStats(data, avgRain, avgTemp, numIterations, fruits=None, maxBytes=MAX_BOOTSTRAP_BYTES, confidence=0.95, seed=None,
+                    rainWindow=RAIN_WINDOW, tempWindow=TEMP_WINDOW):
     # averageRain and averageTemp are numbers you observe from this year.
-    orangeCounts = []
-    pomegranateCounts = []
-
-    orangeList = fruitYield(data, (avgRain, avgTemp))[1]
-    pomegranateList = fruitYield(data, (avgRain, avgTemp))[0]
-    orangeCounts.extend(orangeList)
-    pomegranateCounts.extend((pomegranateList))
-        # apparently random.choices() automatically samples WITH replacement.
-    bootstrapOrangeMean = 0
-    for i in range(numIterations):
-        sample = np.random.choice(orangeCounts, len(orangeCounts), replace=True)
-        # print(sample)
-        sampleSum = np.sum(sample)
-        bootstrapOrangeMean += (sampleSum / (numIterations * len(orangeCounts)))
-    # print(bootstrapOrangeMean)
-    bootstrapPomegranateMean = 0
-    for i in range(numIterations):
-        sample = np.random.choice(pomegranateCounts, len(pomegranateCounts), replace=True)
-        sampleSum = np.sum(sample)
-        bootstrapPomegranateMean += (sampleSum / (numIterations * len(pomegranateCounts)))
-    # print(bootstrapPomegranateMean)
-
-    return {"orange": bootstrapOrangeMean, "pomegranate": bootstrapPomegranateMean}
+    # returns {fruit: {"mean", "se", "ci"}} for every fruit in fruits (default: all in the store).
+    # the analog years are looked up once and all fruits are bootstrapped from the same resample indices.
+    counts = fruitYields(data, (avgRain, avgTemp), fruits, rainWindow, tempWindow)
+    names = list(counts.keys())
+    if len(names) == 0:
+        return {}
+    stats = bootstrapMeans(np.vstack([counts[fruit] for fruit in names]), numIterations, maxBytes, confidence, seed)
+    return dict(zip(names, stats))
+
+def frootstrap(data, avgRain, avgTemp, numIterations, fruits=None, seed=None, rainWindow=RAIN_WINDOW, tempWindow=TEMP_WINDOW):
+    # averageRain and averageTemp are numbers you observe from this year.
+    # returns the bootstrapped mean yield of each fruit
+    stats = frootstrapStats(data, avgRain, avgTemp, numIterations, fruits, seed=seed, rainWindow=rainWindow, tempWindow=tempWindow)
+    return {fruit: estimate["mean"] for fruit, estimate in stats.items()}
+
+def frootstrapToPrecision(data, avgRain, avgTemp, targetSe=None, rtol=None, maxTime=None, maxIterations=100000, fruits=None,
+                          seed=None, batchIterations=1000, maxBytes=MAX_BOOTSTRAP_BYTES, rainWindow=RAIN_WINDOW, tempWindow=TEMP_WINDOW):
+    # frootstrap that keeps adding bootstrap resamples until the monte carlo standard error of every fruit's mean
+    # is at most targetSe and/or rtol * mean, or maxTime seconds or maxIterations resamples are used up
+    # (see precision.run_until_precision). the se is that of the bootstrap estimate, not the spread of the yields.
+    # returns {fruit: {"mean", "se", "n_samples", "elapsed", "converged", "reason"}}
+    counts = fruitYields(data, (avgRain, avgTemp), fruits, rainWindow, tempWindow)
+    names = list(counts.keys())
+    if len(names) == 0:
+        return {}
+    values = np.vstack([counts[fruit] for fruit in names])
+    if values.shape[1] == 0:
+        raise ValueError("cannot bootstrap from an empty list of yields")
+    rng = np.random.default_rng(seed)
+
+    with inst.span("yield.bootstrap"):
+        result = precision.run_until_precision(lambda size: bootstrapResamples(values, size, rng, maxBytes).T, targetSe, rtol,
+                                               maxTime, maxIterations, batchIterations, name="yield")
+    shared = {key: result[key] for key in ("n_samples", "elapsed", "converged", "reason")}
+    return {fruit: {"mean": result["estimate"][i], "se": result["se"][i], **shared} for i, fruit in enumerate(names)}
+
+class YieldCache:
+    def __init__(self, maxSize=1024, rainStep=0.01, tempStep=0.1):
+        """
+        LRU cache of bootstrapped yield estimates, keyed by fruit, quantized (rain, temp), number of iterations and
+        the version of the weather data, so a change to the history never serves stale estimates.
+
+        Parameters:
+        maxSize: int
+            maximum number of cached estimates, the least recently used one is evicted first
+        rainStep, tempStep: float
+            rain and temp are rounded to multiples of these before lookup
+        """
+        self.maxSize = maxSize
+        self.rainStep = rainStep
+        self.tempStep = tempStep
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def quantize(self, avgRain, avgTemp):
+        return (round(round(avgRain / self.rainStep) * self.rainStep, 10), round(round(avgTemp / self.tempStep) * self.tempStep, 10))
+
+    def frootstrap(self, data, avgRain, avgTemp, numIterations, fruits=None):
+        # cached version of frootstrap. avgRain and avgTemp are quantized before the estimate is computed,
+        # and all fruits that miss are bootstrapped together.
+        store = as_store(data)
+        rain, temp = self.quantize(avgRain, avgTemp)
+        return self.lookup(store, fruits, rain, temp, numIterations,
+                           lambda missing: frootstrap(store, rain, temp, numIterations, fruits=missing))
+
+    def frootstrapToPrecision(self, data, avgRain, avgTemp, targetSe=None, rtol=None, maxTime=None, maxIterations=100000, fruits=None):
+        # cached version of frootstrapToPrecision, keyed by the tolerances in place of the number of iterations
+        store = as_store(data)
+        rain, temp = self.quantize(avgRain, avgTemp)
+        return self.lookup(store, fruits, rain, temp, ("precision", targetSe, rtol, maxTime, maxIterations),
+                           lambda missing: frootstrapToPrecision(store, rain, temp, targetSe, rtol, maxTime, maxIterations, fruits=missing))
+
+    def lookup(self, store, fruits, rain, temp, workload, compute):
+        # cached estimates of the fruits, compute(missing fruits) fills in the ones that are not cached yet
+        fruits = list(fruits) if fruits is not None else store.fruits
+        keys = {fruit: (fruit, rain, temp, workload, store.version) for fruit in fruits}
+
+        result = {}
+        missing = []
+        for fruit, key in keys.items():
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                result[fruit] = self.entries[key]
+                self.hits += 1
+                inst.count("yield.cache_hits")
+            else:
+                missing.append(fruit)
+                self.misses += 1
+                inst.count("yield.cache_misses")
+
+        if missing:
+            computed = compute(missing)
+            for fruit, estimate in computed.items():
+                self.entries[keys[fruit]] = estimate
+                result[fruit] = estimate
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        return {fruit: result[fruit] for fruit in fruits}
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxSize": self.maxSize}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+# shared cache used by the recommender
+YIELD_CACHE = YieldCache()
 
 # print(frootstrap(X, 1.1, 56.8, 10000))
\ No newline at end of file
@@ -1,17 +1,16 @@
 import sys
 import random
-from colorama import init, Fore, Style
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 from datetime import date
 
 import simulateLocationPref as loc_file
 import recommenderSystem as rec_file
 import busyBayes as bayes_file
-
-# Initialize colorama
-init()
+from campusMap import (CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, STANFORD_COORD_LOCS, TREE_COUNTS, SEASONS,
+                       DEFAULT_AVG_TEMP, DEFAULT_AVG_RAIN)
 
 BIRDFEEDER_LOGO = [
     "  ____  _          _   _______           _           ",
@@ -42,16 +41,45 @@ CgggbU8OU qOp qOdoUOdcb
          |||||
 """
 
-CAMPUS_BOUNDS = (0, 3, 0, 2) 
-STANFORD_MAP_DICT = {"ev": [0.5, 1.5], "gsb": [0.5, 0.5], "memchu": [1.5, 0.5], "tressider": [1.5, 1.5], "med": [2.5, 0.5], "engg": [2.5, 1.5]}
-STANFORD_MAP_LOCS = {"ev": [(0, 1), (1, 2)], "gsb": [(0, 1), (0, 1)], "memchu": [(1, 2), (0, 1)], "tressider": [(1, 2), (1, 2)], "med": [(2, 3), (0, 1)], "engg": [(2, 3), (1, 2)]}
-STANFORD_COORD_LOCS = {(0, 1): "ev", (0, 0): "gsb", (1, 0): "memchu", (1, 1): "tressider", (2, 0): "med", (2, 1): "engg"}
-TREE_COUNTS =  {"ev": {"orange": 1, "pomegranate": 1}, "gsb": {"orange": 0, "pomegranate": 0}, "memchu": {"orange": 2, "pomegranate": 0}, "tressider": {"orange": 0, "pomegranate": 0}, "med": {"orange": 1, "pomegranate": 0}, "engg": {"orange": 0, "pomegranate": 1}}
-SEASONS = {"orange": ["december", "january", "february"], "pomegranate": ["october", "november", "december"]}
+BUSY_INPUTS = ["wind", "cloudy", "exams", "academic_holiday"]
+
+
+def precompute_busy():
+    """
+    Busy probability for all 16 combinations of the yes/no answers, keyed by (wind, cloudy, exams, academic_holiday)
+    """
+    combos = list(itertools.product([0, 1], repeat=len(BUSY_INPUTS)))
+    probs = bayes_file.prob_busy_many([dict(zip(BUSY_INPUTS, combo)) for combo in combos])
+    return dict(zip(combos, probs))
+
+
+def warm_fruit_yield(fruit, avg_rain, avg_temp):
+    """
+    Fill the yield cache for a fruit and weather so the recommendation that follows is instant.
+    Returns False if there is not enough historical data for this weather.
+    """
+    try:
+        rec_file.RecommendTrees(None, TREE_COUNTS, SEASONS).expected_fruits_on_tree_month(avg_rain, avg_temp, [fruit])
+    except ValueError:
+        return False
+    return True
+
+
 
 
+def main(plots=True):
+    """
+    Run the interactive session
 
-def main():
+    Parameters:
+    plots: bool
+        show the matplotlib figures; with False (--no-plots) nothing is plotted and matplotlib is never imported
+    """
+    # colorama and matplotlib are only loaded once the session actually starts
+    from colorama import init, Fore, Style
+    init()
+    if plots:
+        import matplotlib.pyplot as plt
 
     def input_valid_str(prompt, valid_values):
         while True:
@@ -76,6 +104,10 @@ def main():
                 flag = True
 
 
+    # work that does not depend on the answers still to come runs in the background while the user types
+    executor = ThreadPoolExecutor(max_workers=2)
+    busy_future = executor.submit(precompute_busy)
+
     # print logo!
     bird_color = Fore.LIGHTBLUE_EX
     feeder_color = Fore.LIGHTGREEN_EX
@@ -99,17 +131,25 @@ def main():
 
     # get pdf of preferred locations
     pref_locs_lst = [x.strip() for x in pref_locs_str.split(',')]
-    pref_obj = loc_file.LocationPref(CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS)
-    pref_pdf = pref_obj.create_pref_pdf(pref_locs_lst)
-    prob_locs = pref_obj.probability_locs(pref_pdf)
+    pref_obj = loc_file.LocationPref(CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, mode="analytic")
+    prob_locs = pref_obj.pref_probability_locs(pref_locs_lst)
 
-    print("\nBased on these location preferences, here is the contour map representing the distribution of the probability densities that you would visit a certain location on campus!\n")
-    fig1, ax1 = pref_obj.visualize(pref_pdf)
-    plt.show()
+    if plots:
+        pref_pdf = pref_obj.create_pref_pdf(pref_locs_lst)
+        print("\nBased on these location preferences, here is the contour map representing the distribution of the probability densities that you would visit a certain location on campus!\n")
+        fig1, ax1 = pref_obj.visualize(pref_pdf)
+        plt.show()
+    else:
+        print("\nBased on these location preferences, here are the probabilities that you would visit each location on campus!\n")
+        for coords, loc in STANFORD_COORD_LOCS.items():
+            print(f"  {loc:<10} {prob_locs[coords]:.3f}")
 
     fruit = input_valid_lst("\nNow, please tell us what fruit you would like to pick of the following: orange, pomegranate\n", ["orange", "pomegranate"])
     fruit = fruit.strip().lower()
 
+    # speculatively start on the default weather while the remaining questions are answered
+    yield_futures = {(DEFAULT_AVG_RAIN, DEFAULT_AVG_TEMP): executor.submit(warm_fruit_yield, fruit, DEFAULT_AVG_RAIN, DEFAULT_AVG_TEMP)}
+
     # ensure fruit can be picked in this month
     month = date.today().strftime("%B")
 
@@ -120,50 +160,63 @@ def main():
 
     flag = input_valid_str("\nWhat is the average temperature and rainfall over the past year? If you would like to input these values yourself, type yes. Else we can use the following default values calculated for the past year: avg_temp = 60 degrees F and avg_rain = 1.51 inches. For this option, type no.\n", ["yes", "no"])
     if flag == "no":
-        avg_temp = 60
-        avg_rain = 1.51
+        avg_temp = DEFAULT_AVG_TEMP
+        avg_rain = DEFAULT_AVG_RAIN
     else:
         avg_temp = float(input("\nEnter the average temperature over the past year. Please ensure that this value is in the range of 58F to 70F: "))
         avg_rain = float(input("\nEnter the average rainfall over the past year. Please ensure that this value is in the range of 1in to 2in: "))
 
 
+    if (avg_rain, avg_temp) not in yield_futures:
+        yield_futures[(avg_rain, avg_temp)] = executor.submit(warm_fruit_yield, fruit, avg_rain, avg_temp)
+
     print("\nCalculating the best location to visit...\n\n")
     
+    yield_futures[(avg_rain, avg_temp)].result()
     try:
         # define recommender object
         rec_obj = rec_file.RecommendTrees(prob_locs, TREE_COUNTS, SEASONS)
         scaled_values, loc_to_visit = rec_obj.recommend_location(CAMPUS_BOUNDS, STANFORD_MAP_LOCS, fruit, STANFORD_COORD_LOCS, avg_rain, avg_temp)
+    except (ValueError, ZeroDivisionError):
+        # no past years fall in the weather window, so there is nothing to bootstrap from
+        print("\nOh no! There's not enough historical data that aligns with the current weather conditions :( Fruit yield predictions unfortunately cannot be made.")
+        print("\nThank you for using BirdFeeder! Enjoy picking fruits :)\n\n")
+        executor.shutdown(wait=False, cancel_futures=True)
+        return
 
-        print("\nNow let's see what the probability distributions were for finding fruit for each location!")
+    print("\nNow let's see what the probability distributions were for finding fruit for each location!")
+    if plots:
         fig, ax = rec_obj.visualize(scaled_values)
         plt.title("Probability Distribution of Finding Fruits")
         plt.show()
+    else:
+        for loc, prob in zip(*rec_file.location_probabilities(scaled_values, STANFORD_MAP_LOCS)):
+            print(f"  {loc:<10} {prob:.3f}")
 
-        print("\nNow if you would answer a few questions, we can let you know the probability of the trees you are visiting being busy, where busy means that 3+ people may be at the tree. Please answer these questions with a yes or no.")
-
-        def val_to_num(val):
-            if val == "yes":
-                return 1
-            else:
-                return 0
+    print("\nNow if you would answer a few questions, we can let you know the probability of the trees you are visiting being busy, where busy means that 3+ people may be at the tree. Please answer these questions with a yes or no.")
 
-        wind = val_to_num(input_valid_str("\nIs it windy outside?\n", ["yes", "no"]))
-        cloudy = val_to_num(input_valid_str("\nIs it cloudy outside?\n", ["yes", "no"]))
-        exams = val_to_num(input_valid_str("\nIs it finals period right now?\n", ["yes", "no"]))
-        academic_holiday = val_to_num(input_valid_str("\nIs it spring, winter, summer, or thanksgiving break?\n", ["yes", "no"]))
+    def val_to_num(val):
+        if val == "yes":
+            return 1
+        else:
+            return 0
 
-        print("\nLoading the probability...\nThis may take a minute...\n")
-        
-        observation = {"wind":wind, "cloudy":cloudy, "exams":exams, "academic_holiday":academic_holiday} 
-        prob_busy = bayes_file.prob_busy(observation)
-        print(f"\nThank you for this information.\nThe probability that the tree is busy at {loc_to_visit} is {prob_busy}.") 
-
-    except:
-        print("\nOh no! There's not enough historical data that aligns with the current weather conditions :( Fruit yield predictions unfortunately cannot be made.")
+    wind = val_to_num(input_valid_str("\nIs it windy outside?\n", ["yes", "no"]))
+    cloudy = val_to_num(input_valid_str("\nIs it cloudy outside?\n", ["yes", "no"]))
+    exams = val_to_num(input_valid_str("\nIs it finals period right now?\n", ["yes", "no"]))
+    academic_holiday = val_to_num(input_valid_str("\nIs it spring, winter, summer, or thanksgiving break?\n", ["yes", "no"]))
 
+    print("\nLoading the probability...\n")
+    
+    prob_busy = busy_future.result()[(wind, cloudy, exams, academic_holiday)]
+    print(f"\nThank you for this information.\nThe probability that the tree is busy at {loc_to_visit} is {prob_busy}.") 
 
     print("\nThank you for using BirdFeeder! Enjoy picking fruits :)\n\n")
+    executor.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Find the best place on campus to glean fruit.")
+    parser.add_argument("--no-plots", action="store_true", help="headless mode: print the probabilities instead of plotting them")
+    args = parser.parse_args(sys.argv[1:])
+    main(plots=not args.no_plots)
 
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import atexit
+import contextlib
+
+# off by default; set BIRDFEEDER_INSTRUMENT=1 or call enable(). When off, span() hands back one shared no-op
+# context manager and count()/gauge() return after a single flag check.
+ENABLED = os.environ.get("BIRDFEEDER_INSTRUMENT", "") not in ("", "0")
+
+_NULL_SPAN = contextlib.nullcontext()
+
+# name -> [calls, total seconds, max seconds]
+_spans = {}
+# name -> running total
+_counters = {}
+# name -> last value
+_gauges = {}
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    _spans.clear()
+    _counters.clear()
+    _gauges.clear()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stats = _spans.get(self.name)
+        if stats is None:
+            _spans[self.name] = [1, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+        return False
+
+
+def span(name):
+    """
+    Context manager timing a pipeline stage, e.g. `with span("recommend.yield"): ...`
+    """
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name, value=1):
+    """
+    Add value to a counter, e.g. the number of samples drawn
+    """
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    """
+    Record the latest value of a quantity, e.g. the acceptance rate of the last sampling run
+    """
+    if ENABLED:
+        _gauges[name] = value
+
+
+def snapshot():
+    """
+    Current spans, counters and gauges as a dict
+    """
+    return {
+        "spans": {name: {"calls": calls, "total_seconds": total, "max_seconds": longest, "mean_seconds": total / calls}
+                  for name, (calls, total, longest) in _spans.items()},
+        "counters": dict(_counters),
+        "gauges": dict(_gauges),
+    }
+
+
+def _metric_name(name):
+    return "birdfeeder_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+def prometheus_text():
+    """
+    Current metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for name, (calls, total, longest) in sorted(_spans.items()):
+        metric = _metric_name(name)
+        lines += [f"# TYPE {metric}_seconds summary", f"{metric}_seconds_count {calls}", f"{metric}_seconds_sum {total:.9f}",
+                  f"# TYPE {metric}_seconds_max gauge", f"{metric}_seconds_max {longest:.9f}"]
+    for name, value in sorted(_counters.items()):
+        metric = _metric_name(name)
+        lines += [f"# TYPE {metric}_total counter", f"{metric}_total {value}"]
+    for name, value in sorted(_gauges.items()):
+        metric = _metric_name(name)
+        lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def export(path):
+    """
+    Write the current metrics to path, as Prometheus text if it ends in .prom and as json otherwise
+    """
+    with open(path, "w") as f:
+        if path.endswith(".prom"):
+            f.write(prometheus_text())
+        else:
+            json.dump(snapshot(), f, indent=2)
+
+
+# write the metrics when the process exits if BIRDFEEDER_METRICS_FILE is set
+if os.environ.get("BIRDFEEDER_METRICS_FILE"):
+    atexit.register(lambda: export(os.environ["BIRDFEEDER_METRICS_FILE"]) if ENABLED else None)
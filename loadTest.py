@@ -0,0 +1,80 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+
+# example bodies for each endpoint
+REQUESTS = {
+    "/preferences": {"locations": ["med", "memchu"]},
+    "/recommend": {"locations": ["ev", "engg"], "fruit": "orange", "avg_rain": 1.51, "avg_temp": 60},
+    "/busy": {"observation": {"wind": 1, "cloudy": 0, "exams": 0, "academic_holiday": 1}},
+}
+
+
+async def request(reader, writer, host, path, payload):
+    body = json.dumps(payload).encode()
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        if key.strip().lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def client(host, port, path, payload, n_requests, latencies, errors):
+    # one keep-alive connection sending its requests back to back
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(n_requests):
+            start = time.perf_counter()
+            status = await request(reader, writer, host, path, payload)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def load_test(host, port, path, n_requests, concurrency):
+    """
+    Send n_requests to path over concurrency connections and return latency percentiles and throughput
+    """
+    latencies, errors = [], []
+    per_client = [n_requests // concurrency + (1 if i < n_requests % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, path, REQUESTS[path], n, latencies, errors) for n in per_client if n > 0])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {"endpoint": path, "requests": len(latencies), "errors": len(errors),
+            "p50_ms": float(np.percentile(latencies, 50)), "p99_ms": float(np.percentile(latencies, 99)),
+            "throughput_rps": len(latencies) / elapsed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test a running BirdFeeder service.")
+    parser.add_argument("--host", default="127.0.0.1", help="service address")
+    parser.add_argument("--port", type=int, default=8765, help="service port")
+    parser.add_argument("--endpoint", choices=list(REQUESTS) + ["all"], default="all", help="endpoint to load")
+    parser.add_argument("--requests", type=int, default=1000, help="number of requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of concurrent connections")
+    args = parser.parse_args(argv)
+
+    endpoints = list(REQUESTS) if args.endpoint == "all" else [args.endpoint]
+    for path in endpoints:
+        result = asyncio.run(load_test(args.host, args.port, path, args.requests, args.concurrency))
+        print(f"{result['endpoint']:<13} {result['requests']} requests, {result['errors']} errors, "
+              f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, {result['throughput_rps']:.0f} req/s")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,116 @@
+import time
+import numpy as np
+
+import instrumentation as inst
+
+# stop reasons reported by run_until_precision
+TARGET_REACHED = "target"
+MAX_SAMPLES = "max_samples"
+MAX_TIME = "max_time"
+
+
+def run_until_precision(draw, target_se=None, rtol=None, max_time=None, max_samples=10**6, batch_size=1000, min_samples=None,
+                        name="precision"):
+    """
+    Run a Monte Carlo estimator in batches until its standard error is small enough or a budget runs out.
+    The estimate is the weighted mean sum(w * x) / sum(w) of the draws, and its squared standard error is
+    sum(w^2 (x - estimate)^2) / sum(w)^2, which reduces to the usual variance / n for unit weights.
+
+    Parameters:
+    draw: function
+        draw(n) returns n new draws, either as values ((n,) or (n, k) for k estimates at once) or as a tuple
+        (values, weights) with one weight per draw, e.g. the likelihood weights of a sampler
+    target_se: float or None
+        stop once the standard error is at most this
+    rtol: float or None
+        stop once the standard error is at most rtol * |estimate|. With both tolerances, both have to hold.
+    max_time: float or None
+        stop after this many seconds (checked between batches)
+    max_samples: int
+        stop after this many draws
+    batch_size: int
+        size of the first batch, later batches are sized from the standard error seen so far
+    min_samples: int or None
+        draws needed before the tolerances are checked, the first batch by default
+    name: string
+        prefix of the instrumentation counters
+
+    Returns a dict with the "estimate" and its standard error "se" (floats, or arrays for (n, k) draws), the number
+    of draws "n_samples", the effective sample size "ess", the "elapsed" seconds, whether the tolerances were met
+    ("converged") and the "reason" the run stopped. Without tolerances it runs to max_samples.
+    """
+    has_target = target_se is not None or rtol is not None
+    min_samples = batch_size if min_samples is None else min_samples
+    start = time.perf_counter()
+
+    # running sums of w, w * x, w^2 x^2, w^2 x and w^2
+    sum_w = sum_wx = sum_w2x2 = sum_w2x = sum_w2 = 0.0
+    n = 0
+    size = min(batch_size, max_samples)
+    while True:
+        drawn = draw(size)
+        values, weights = drawn if isinstance(drawn, tuple) else (drawn, None)
+        values = np.asarray(values, dtype=float)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=float)
+        w = weights.reshape((-1,) + (1,) * (values.ndim - 1))
+
+        sum_w += np.sum(weights)
+        sum_w2 += np.sum(weights ** 2)
+        sum_wx = sum_wx + np.sum(w * values, axis=0)
+        sum_w2x = sum_w2x + np.sum(w ** 2 * values, axis=0)
+        sum_w2x2 = sum_w2x2 + np.sum(w ** 2 * values ** 2, axis=0)
+        n += len(values)
+
+        if sum_w > 0:
+            estimate = sum_wx / sum_w
+            se = np.sqrt(np.maximum(sum_w2x2 - 2 * estimate * sum_w2x + estimate ** 2 * sum_w2, 0)) / sum_w
+        else:
+            estimate, se = np.nan, np.inf
+        elapsed = time.perf_counter() - start
+
+        converged = bool(has_target and n >= min_samples and sum_w > 0
+                         and (target_se is None or np.all(se <= target_se))
+                         and (rtol is None or np.all(se <= rtol * np.abs(estimate))))
+        if converged:
+            reason = TARGET_REACHED
+        elif n >= max_samples:
+            reason = MAX_SAMPLES
+        elif max_time is not None and elapsed >= max_time:
+            reason = MAX_TIME
+        else:
+            size = next_batch_size(n, se, estimate, target_se, rtol, batch_size, max_samples)
+            if max_time is not None:
+                # don't start a batch that would run far past the time budget
+                size = max(1, min(size, int((max_time - elapsed) / elapsed * n) + 1))
+            continue
+        break
+
+    if sum_w == 0:
+        raise ValueError("every draw had zero weight")
+    inst.count(f"{name}.samples_drawn", n)
+    inst.gauge(f"{name}.se", float(np.max(se)))
+    return {"estimate": estimate.tolist() if np.ndim(estimate) else float(estimate),
+            "se": se.tolist() if np.ndim(se) else float(se),
+            "n_samples": n, "ess": float(sum_w ** 2 / sum_w2), "elapsed": elapsed,
+            "converged": converged, "reason": reason}
+
+
+def next_batch_size(n, se, estimate, target_se, rtol, batch_size, max_samples):
+    """
+    Draws still needed for the tolerances assuming se shrinks like 1 / sqrt(n), at least batch_size and at most
+    doubling n per batch so one noisy early estimate can't overshoot the budget
+    """
+    if target_se is None and rtol is None:
+        # fixed workload, just get there in as few batches as the doubling allows
+        return int(min(max_samples - n, n))
+    needed = n
+    tolerance = np.inf
+    if target_se is not None:
+        tolerance = np.minimum(tolerance, target_se)
+    if rtol is not None:
+        tolerance = np.minimum(tolerance, rtol * np.abs(estimate))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.max(np.asarray(se, dtype=float) / tolerance)
+    if np.isfinite(ratio):
+        needed = int(np.ceil(n * ratio ** 2 * 1.1)) - n
+    return int(min(max(needed, batch_size), n, max_samples - n))
@@ -1,13 +1,48 @@
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import scipy.stats as stats
-import json
 
 import fruitYield 
+import precision
+import instrumentation as inst
+
+
+def top_k_locations(user_probs, expected, k):
+    """
+    Indices and scores of the k best locations for every user, best first
+    user_probs: numpy array
+        (n_users, n_locations) preference probabilities
+    expected: numpy array
+        (n_locations,) expected fruit in each location
+    k: int
+        Number of locations per user
+    """
+    scores = np.asarray(user_probs) * expected[None, :]
+    k = min(k, scores.shape[1])
+    if k == 1:
+        top = np.argmax(scores, axis=1)[:, None]
+    else:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+    return top, np.take_along_axis(scores, top, axis=1)
+
+def location_probabilities(scaled_values, map_locs):
+    """
+    Labels and normalized values of the locations laid out on the campus matrix, in the order of map_locs
+    scaled_values: numpy array
+        campus matrix with the value of the location [(x1, x2), (y1, y2)] at [x1][y1]
+    map_locs: dict
+        {location: [(x1, x2), (y1, y2)]} defining the coordinates of the boundary for each location
+    """
+    labels = [loc for loc, coords in map_locs.items() if len(coords) == 2]
+    values = np.array([scaled_values[map_locs[loc][0][0], map_locs[loc][1][0]] for loc in labels], dtype=float)
+    total = np.sum(values)
+    return labels, values / total if total > 0 else values
 
 class RecommendTrees:
-    def __init__(self, pref_probs, tree_counts, seasons):
+    def __init__(self, pref_probs, tree_counts, seasons, seed=None, trees=None, precision=None):
         """
         Initialize Recommender System
 
@@ -15,9 +50,18 @@ class RecommendTrees:
         pref_probs: numpy array
             array with probabilities for each location
         tree_counts: dict
-            {location: {fruit: num_trees}} for number of trees of a fruit in a given location
+            {location: {fruit: num_trees}} for number of trees of a fruit in a given location, can be None if trees is given
         seasons: dict
             {fruit: [months]} with list of months that the fruit will yield fruit in the year
+        seed: int or None
+            Seed for the random number generator used by the simulations
+        trees: TreeRegistry
+            Registry of the individual trees, needed for recommend_trees. Without tree_counts the locations are the
+            registry's region_names, in that order.
+        precision: dict or None
+            {"target_se", "rtol", "max_time", "max_samples"} (any subset) to run the yield bootstrap and the pick
+            simulation until that precision instead of a fixed workload. target_se is in each estimator's own units,
+            so rtol is usually the one to set. The achieved precision is kept in self.precision_report.
         """
 
         self.pref_probs = pref_probs
@@ -27,37 +71,99 @@ class RecommendTrees:
         }
         self.fruit_range_midpoints = [2, 5, 8.5, 12]
         self.seasons = seasons
+        self.rng = np.random.default_rng(seed)
+        self.trees = trees
+        self.precision = precision
+        self.precision_report = {}
+        # location layout of the last recommend_location call, used to label visualize
+        self.map_locs = None
+
+        # (location x fruit) matrix of tree counts, rows in self.locations order and columns in self.fruits order
+        self.fruits = list(seasons.keys())
+        if tree_counts is None:
+            counts = trees.count_matrix(trees.region_names, self.fruits)
+            tree_counts = {loc: {fruit: int(n) for fruit, n in zip(self.fruits, row)} for loc, row in zip(trees.region_names, counts)}
         self.tree_counts = tree_counts
+        self.locations = list(tree_counts.keys())
+        self.tree_count_matrix = np.array([[tree_counts[loc].get(fruit, 0) for fruit in self.fruits] for loc in self.locations], dtype=float).reshape(len(self.locations), len(self.fruits))
     
     # NOTE: this would be replaced by actual user data in the future
-    def simulate_expected_fruit_picked(self, fruit):
+    def simulate_fruit_picked(self, fruit, days=30, replicates=1, n_trees=1):
+        """
+        Simulate the expected number of fruit picked per day from each of n_trees fruit trees, with all days, trees and replicates drawn at once.
+        fruit: string
+            Name of the fruit tree for which data is to be simulated
+        days: int
+            Number of days simulated per replicate
+        replicates: int
+            Number of independent runs of the horizon that are averaged
+        n_trees: int
+            Number of trees simulated
+        """
+        # number of ppl who visit a tree in a day is normal w mean 4 and std 2, rounded and clipped at 0
+        # all the ppl visiting on a day together pick from one multinomial over the fruit ranges
+        # expected value of fruits picked in a day is then averaged over the days and replicates
+
+        with inst.span("recommend.simulate_picked"):
+            daily_expect = self.simulate_daily_picked(fruit, (replicates, n_trees, days))
+
+        return np.mean(daily_expect, axis=(0, 2))
+
+    def simulate_daily_picked(self, fruit, shape):
+        """
+        Expected number of fruit picked from a tree on each of an array of independently simulated tree-days
+        fruit: string
+            Name of the fruit tree for which data is to be simulated
+        shape: tuple
+            Shape of the array of tree-days
+        """
+        fruit_pick_probs = np.array(self.fruit_pick_probs[fruit])
+        num_ppl_visit = np.maximum(np.round(self.rng.normal(4, 2, size=shape)), 0).astype(np.int64)
+        picked = self.rng.multinomial(num_ppl_visit, fruit_pick_probs)
+        inst.count("recommend.simulated_tree_days", num_ppl_visit.size)
+        return picked @ (np.array(self.fruit_range_midpoints) * fruit_pick_probs)
+
+    def simulate_expected_fruit_picked(self, fruit, days=30, replicates=1):
         """
         Simulate the expected number of fruit picked from a single fruit tree in a month (assumption made here is that a month is a 30-day period).
         fruit: string
             Name of the fruit tree for which data is to be simulated
+        days: int
+            Number of days simulated per replicate
+        replicates: int
+            Number of independent runs of the horizon that are averaged
         """
-        # simulate number of ppl who visit tree in a day normal w mean 4 and var/std 2
-        # sample number of ppl from gauss
-        # sample for each person the number of fruit picked from multinomial and calculcated expected value of fruits picked in a day
-        # do this for all 30 days and take avg
-
-        fruit_pick_probs = self.fruit_pick_probs[fruit]
-        expected_val = 0
-        for day in range(30):
-            num_ppl_visit_today = int(round(stats.norm.rvs(4, 2, size=1)[0]))
-            today_dat = np.array([0, 0, 0, 0])
-            for person in range(num_ppl_visit_today):
-                fruit_picked = stats.multinomial.rvs(1, fruit_pick_probs, size=1)
-                today_dat += fruit_picked[0]
-            today_expect = 0
-            for cat in range(len(today_dat)):
-                numfruit = today_dat[cat] * self.fruit_range_midpoints[cat]
-                today_expect += numfruit * fruit_pick_probs[cat]
-            expected_val += today_expect
-        
-        expected_val = expected_val / 30
 
-        return expected_val
+        return float(self.simulate_fruit_picked(fruit, days, replicates)[0])
+
+    def simulate_expected_fruit_picked_to_precision(self, fruit, target_se=None, rtol=None, max_time=None, max_samples=10**6):
+        """
+        Simulate the expected number of fruit picked from a single fruit tree per day, adding simulated days until the
+        standard error reaches target_se and/or rtol * estimate, or max_time seconds or max_samples days are used up.
+        Returns a dict with the "estimate", its "se", "n_samples", "elapsed", "converged" and the stop "reason".
+        fruit: string
+            Name of the fruit tree for which data is to be simulated
+        """
+        with inst.span("recommend.simulate_picked"):
+            return precision.run_until_precision(lambda size: self.simulate_daily_picked(fruit, (size,)), target_se, rtol,
+                                                 max_time, max_samples, batch_size=30, name="recommend.picked")
+
+    def expected_fruits_on_tree_month(self, pastmo_rain, pastmo_temp, fruits=None):
+        """
+        Get the expected number of fruit on a single tree in a month for several fruits, from one shared bootstrap
+        pastmo_rain: float
+            Average rainfall in inches over the past year
+        pastmo_temp: float  
+            Average temperature in inches over the past year 
+        fruits: list
+            Names of the fruits, defaults to every fruit in self.seasons
+        """
+
+        fruits = fruits if fruits is not None else self.fruits
+        with inst.span("recommend.expected_yield"):
+            fruit_counts = self.expected_fruit_yields(pastmo_rain, pastmo_temp, fruits)
+
+        return {fruit: expected_year/len(self.seasons[fruit]) for fruit, expected_year in fruit_counts.items()}
 
     def expected_fruit_on_tree_month(self, fruit, pastmo_rain, pastmo_temp):
         """
@@ -70,14 +176,37 @@ class RecommendTrees:
             Average temperature in inches over the past year 
         """
 
-        with open("weatherData.json", "r") as f:
-            data = json.load(f)
-        fruit_counts = fruitYield.frootstrap(data, pastmo_rain, pastmo_temp, 10000)
+        with inst.span("recommend.expected_yield"):
+            fruit_counts = self.expected_fruit_yields(pastmo_rain, pastmo_temp, [fruit])
         expected_year = fruit_counts[fruit]
         fruit_season = self.seasons[fruit] 
 
         return expected_year/len(fruit_season)
 
+    def expected_fruit_yields(self, pastmo_rain, pastmo_temp, fruits):
+        """
+        Bootstrapped yearly yield of each fruit from the shared cache, with 10000 iterations or to self.precision
+        """
+        if self.precision is None:
+            return fruitYield.YIELD_CACHE.frootstrap(fruitYield.X, pastmo_rain, pastmo_temp, 10000, fruits=fruits)
+        stats = fruitYield.YIELD_CACHE.frootstrapToPrecision(fruitYield.X, pastmo_rain, pastmo_temp, self.precision.get("target_se"),
+                                                             self.precision.get("rtol"), self.precision.get("max_time"),
+                                                             self.precision.get("max_samples", 100000), fruits=fruits)
+        for fruit, estimate in stats.items():
+            self.precision_report[f"yield.{fruit}"] = estimate
+        return {fruit: estimate["mean"] for fruit, estimate in stats.items()}
+
+    def expected_fruit_picked(self, fruit):
+        """
+        Simulated number of fruit picked from a single tree per day, over 30 days or to self.precision
+        """
+        if self.precision is None:
+            return self.simulate_expected_fruit_picked(fruit)
+        result = self.simulate_expected_fruit_picked_to_precision(fruit, **self.precision)
+        self.precision_report[f"picked.{fruit}"] = {"mean": result["estimate"], **{key: result[key] for key in
+                                                    ("se", "n_samples", "elapsed", "converged", "reason")}}
+        return result["estimate"]
+
     def expected_fruit_in_loc(self, expected_picked, expected_yield, location, fruit):
         """
         Get the expected number of fruit in a location in a month (assumption made here is that a month is a 30-day period)
@@ -89,6 +218,104 @@ class RecommendTrees:
         num_trees = self.tree_counts[location][fruit]
         return (expected_yield - expected_picked) * num_trees
     
+    def expected_fruit_tensor(self, pastmo_rain, pastmo_temp, fruits=None):
+        """
+        Return the (location x fruit) matrix of the expected number of fruit in a month, rows in self.locations order.
+        The per-tree yield and pick estimates do not depend on the location, so they are computed once per fruit and broadcast against the tree counts.
+        pastmo_rain: float
+            Average rainfall in inches over the past year
+        pastmo_temp: float  
+            Average temperature in inches over the past year
+        fruits: list
+            Names of the fruits (columns), defaults to self.fruits
+        """
+        fruits = fruits if fruits is not None else self.fruits
+        per_tree = self.expected_fruit_per_tree(pastmo_rain, pastmo_temp, fruits)
+        cols = [self.fruits.index(fruit) for fruit in fruits]
+
+        return self.tree_count_matrix[:, cols] * per_tree[None, :]
+
+    def expected_fruit_per_tree(self, pastmo_rain, pastmo_temp, fruits):
+        """
+        Return the expected number of fruit left on a single tree in a month for each of the fruits
+        """
+        expected_yield = self.expected_fruits_on_tree_month(pastmo_rain, pastmo_temp, fruits)
+        return np.array([expected_yield[fruit] - self.expected_fruit_picked(fruit) for fruit in fruits])
+
+    def pref_probs_by_location(self, map_locs=None):
+        """
+        Return the preference probability of each location in self.locations order
+        map_locs: dict
+            {location: [(x1, x2), (y1, y2)]}, needed when pref_probs is a matrix with the probability of a location at [x1][y1]
+        """
+        if isinstance(self.pref_probs, dict):
+            return np.array([self.pref_probs.get(loc, 0) for loc in self.locations], dtype=float)
+        pref_probs = np.asarray(self.pref_probs, dtype=float)
+        if pref_probs.ndim == 1:
+            return pref_probs
+        if map_locs is None:
+            raise ValueError("map_locs is needed to read location probabilities from a matrix")
+        return np.array([pref_probs[map_locs[loc][0][0], map_locs[loc][1][0]] if loc in map_locs else 0 for loc in self.locations])
+
+    def recommend_regions(self, fruit, pastmo_rain, pastmo_temp, k=1, map_locs=None):
+        """
+        Return the k locations with the largest probability of finding fruit as [(location, score)], best first
+        fruit: string
+            Name of the fruit tree for which data is to be calculated
+        pastmo_rain: float
+            Average rainfall in inches over the past year
+        pastmo_temp: float  
+            Average temperature in inches over the past year 
+        k: int
+            Number of locations to return
+        map_locs: dict
+            {location: [(x1, x2), (y1, y2)]}, needed when pref_probs is a matrix
+        """
+        scores = self.expected_fruit_tensor(pastmo_rain, pastmo_temp, [fruit])[:, 0] * self.pref_probs_by_location(map_locs)
+        best = heapq.nlargest(k, range(len(self.locations)), key=scores.__getitem__)
+        return [(self.locations[i], float(scores[i])) for i in best]
+
+    def recommend_trees(self, fruit, pastmo_rain, pastmo_temp, user_location=None, k=5, radius=None, map_locs=None):
+        """
+        Return the k individual trees with the largest probability of finding fruit, best first, as a list of
+        {"id", "fruit", "x", "y", "region", "score"} dicts
+        fruit: string
+            Name of the fruit tree for which data is to be calculated
+        pastmo_rain: float
+            Average rainfall in inches over the past year
+        pastmo_temp: float  
+            Average temperature in inches over the past year 
+        user_location: tuple
+            (x, y) of the user. Only trees within radius of it are considered, or without a radius the k trees of
+            the fruit closest to it
+        k: int
+            Number of trees to return
+        radius: float
+            Search radius around user_location
+        map_locs: dict
+            {location: [(x1, x2), (y1, y2)]}, needed when pref_probs is a matrix
+        """
+        if self.trees is None:
+            raise ValueError("recommend_trees needs a TreeRegistry")
+        candidates = None
+        if user_location is not None and radius is not None:
+            candidates = self.trees.near(user_location, radius=radius)
+        candidates = self.trees.of_fruit(fruit, candidates)
+        if user_location is not None and radius is None:
+            candidates = self.trees.closest(user_location, k, candidates)
+        if len(candidates) == 0:
+            return []
+
+        per_tree = self.expected_fruit_per_tree(pastmo_rain, pastmo_temp, [fruit])[0]
+        loc_probs = dict(zip(self.locations, self.pref_probs_by_location(map_locs)))
+        region_probs = np.array([loc_probs.get(region, 0) for region in self.trees.region_names])
+        scores = per_tree * region_probs[self.trees.region_codes[candidates]]
+
+        best = heapq.nlargest(k, range(len(candidates)), key=scores.__getitem__)
+        return [{"id": self.trees.ids[candidates[i]].item(), "fruit": fruit,
+                 "x": float(self.trees.coords[candidates[i], 0]), "y": float(self.trees.coords[candidates[i], 1]),
+                 "region": self.trees.region_names[self.trees.region_codes[candidates[i]]], "score": float(scores[i])} for i in best]
+
     def calculate_fruit_in_all_locs(self, campus_boundary, stanford_map_locs, fruit, pastmo_rain, pastmo_temp):
         """
         Return the expected number of a fruit in each location in a month (assumption made here is that a month is a 30-day period)
@@ -104,16 +331,54 @@ class RecommendTrees:
             Average temperature in inches over the past year    
         """
         all_expected = np.zeros((campus_boundary[1], campus_boundary[3]))
+        loc_fruit = self.expected_fruit_tensor(pastmo_rain, pastmo_temp, [fruit])[:, 0]
 
         for loc, coords in stanford_map_locs.items():
-            expected_picked = self.simulate_expected_fruit_picked(fruit)
-            expected_yield = self.expected_fruit_on_tree_month(fruit, pastmo_rain, pastmo_temp)
-            loc_fruit = self.expected_fruit_in_loc(expected_picked, expected_yield, loc, fruit)
-            all_expected[coords[0][0], coords[1][0]] = loc_fruit
+            all_expected[coords[0][0], coords[1][0]] = loc_fruit[self.locations.index(loc)]
         
         return all_expected
 
-    def recommend_location(self, campus_boundary, stanford_map_locs, fruit, stanford_coord_locs, pastmo_rain, pastmo_temp):
+    def recommend_many(self, user_probs, fruit, pastmo_rain, pastmo_temp, k=1, columns=None, workers=None, chunk_size=100000):
+        """
+        Recommend locations for many users at once. The expected fruit in each location is computed once and shared by every user.
+        user_probs: numpy array
+            (n_users, n_locations) matrix with one row of location probabilities per user
+        fruit: string
+            Name of the fruit tree for which data is to be calculated
+        pastmo_rain: float
+            Average rainfall in inches over the past year
+        pastmo_temp: float  
+            Average temperature in inches over the past year 
+        k: int
+            Number of locations to recommend per user
+        columns: list
+            Location names of the columns of user_probs (e.g. LocationPref.region_names), defaults to self.locations
+        workers: int
+            If given, chunks of chunk_size users are scored in a pool of this many processes
+        chunk_size: int
+            Number of users per chunk
+
+        Returns a dict with the (n_users, k) arrays "locations" and "scores", best first, and "expected", the expected fruit each user finds over all locations.
+        """
+        user_probs = np.asarray(user_probs, dtype=float)
+        if columns is not None:
+            order = [list(columns).index(loc) if loc in columns else -1 for loc in self.locations]
+            user_probs = np.where(np.array(order) >= 0, user_probs[:, order], 0)
+        expected = self.expected_fruit_tensor(pastmo_rain, pastmo_temp, [fruit])[:, 0]
+
+        inst.count("recommend.users", len(user_probs))
+        if workers is not None and len(user_probs) > chunk_size:
+            chunks = [user_probs[start:start + chunk_size] for start in range(0, len(user_probs), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(top_k_locations, chunks, repeat(expected), repeat(k)))
+            top = np.concatenate([result[0] for result in results])
+            scores = np.concatenate([result[1] for result in results])
+        else:
+            top, scores = top_k_locations(user_probs, expected, k)
+
+        return {"locations": np.array(self.locations, dtype=object)[top], "scores": scores, "expected": user_probs @ expected}
+
+    def recommend_location(self, campus_boundary, stanford_map_locs, fruit, stanford_coord_locs=None, pastmo_rain=1.51, pastmo_temp=60):
         """
         Return the location with the largest probability of finding fruit
         campus_boundary: tuple
@@ -123,26 +388,40 @@ class RecommendTrees:
         fruit: string
             Name of the fruit tree for which data is to be calculated
         stanford_coord_locs:
-            For each coordinate of the resultant matrix, it provides the respective location on campus
+            Unused, the location is now picked from self.locations. Kept for existing callers.
         pastmo_rain: float
             Average rainfall in inches over the past year
         pastmo_temp: float  
             Average temperature in inches over the past year 
         """
-        all_locs_values = self.calculate_fruit_in_all_locs(campus_boundary, stanford_map_locs, fruit, pastmo_rain, pastmo_temp)
-        scaled_values = np.array(all_locs_values) * np.array(self.pref_probs)
-        max_loc_ind = list(np.unravel_index(np.argmax(scaled_values, axis=None), scaled_values.shape))
-        max_loc = stanford_coord_locs[tuple(max_loc_ind)]
+        with inst.span("recommend.location"):
+            loc_fruit = self.expected_fruit_tensor(pastmo_rain, pastmo_temp, [fruit])[:, 0]
+            loc_scores = loc_fruit * self.pref_probs_by_location(stanford_map_locs)
+            max_loc = self.locations[heapq.nlargest(1, range(len(self.locations)), key=loc_scores.__getitem__)[0]]
+
+        # lay the scores out on the campus matrix for visualize
+        self.map_locs = stanford_map_locs
+        scaled_values = np.zeros((campus_boundary[1], campus_boundary[3]))
+        for loc, coords in stanford_map_locs.items():
+            if loc in self.locations:
+                scaled_values[coords[0][0], coords[1][0]] = loc_scores[self.locations.index(loc)]
         print(f"There are {self.tree_counts[max_loc][fruit]} {fruit} trees that you can pick fruits from in {max_loc}!")
         return scaled_values, max_loc
     
-    def visualize(self, scaled_values):
+    def visualize(self, scaled_values, map_locs=None):
         """
         Visualize the probability distribution for finding fruit in each location on campus. 
+        scaled_values: numpy array
+            campus matrix returned by recommend_location
+        map_locs: dict
+            {location: [(x1, x2), (y1, y2)]} the matrix was laid out with, by default the one of the last recommend_location
         """
-        probs = (scaled_values.T / sum(sum(scaled_values))).flatten()
-
-        locs = ["gsb", "memchu", "med", "ev", "tressider", "engg"]
+        # matplotlib is only loaded when something is actually plotted
+        import matplotlib.pyplot as plt
+        map_locs = self.map_locs if map_locs is None else map_locs
+        if map_locs is None:
+            raise ValueError("map_locs is needed to label the locations of the campus matrix")
+        locs, probs = location_probabilities(scaled_values, map_locs)
 
         fig, ax = plt.subplots(figsize=(8, 6))
         
@@ -0,0 +1,249 @@
+import sys
+import json
+import math
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import fruitYield
+import busyBayes
+import simulateLocationPref as loc_file
+import recommenderSystem as rec_file
+from campusMap import CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, TREE_COUNTS, SEASONS
+
+# models of the current process, loaded once by warm_up
+_MODELS = {}
+
+MAX_BODY_BYTES = 1 << 20
+
+# most time one request may spend on a precision target, and the request fields that set one
+MAX_PRECISION_SECONDS = 2.0
+PRECISION_KEYS = {"target_se": float, "rtol": float, "max_time": float, "max_samples": int}
+
+
+def warm_up():
+    """
+    Load the weather store, the preference model and the busyness network once per worker process
+    """
+    fruitYield.X.load()
+    fruitYield.analogIndex(fruitYield.X)
+    _MODELS["pref"] = loc_file.LocationPref(CAMPUS_BOUNDS, STANFORD_MAP_DICT, STANFORD_MAP_LOCS, mode="analytic")
+    _MODELS["net"] = busyBayes.NET
+
+
+def precision_args(payload):
+    """
+    Precision target of a request as keyword arguments for the estimators, or None if it asks for none.
+    The time budget is capped at MAX_PRECISION_SECONDS.
+    """
+    args = {key: cast(payload[key]) for key, cast in PRECISION_KEYS.items() if payload.get(key) is not None}
+    if not args:
+        return None
+    for key, value in args.items():
+        # a nan or non-positive tolerance can never be met and would quietly spend the whole sample budget
+        if not math.isfinite(value) or value <= 0:
+            raise ValueError(f"{key} must be a positive number")
+    args["max_time"] = min(args.get("max_time", MAX_PRECISION_SECONDS), MAX_PRECISION_SECONDS)
+    return args
+
+
+def handle(path, payload):
+    """
+    Answer one request on a warm worker. Returns (status, response dict).
+
+    path: string
+        "/preferences", "/recommend" or "/busy"
+    payload: dict
+        decoded json body of the request. /recommend and /busy also take "target_se", "rtol", "max_time" and
+        "max_samples" to run their Monte Carlo estimates to a precision, and then report the precision reached.
+    """
+    if not _MODELS:
+        warm_up()
+    pref = _MODELS["pref"]
+    if not isinstance(payload, dict):
+        raise ValueError("request body must be a json object")
+    if path in ("/preferences", "/recommend"):
+        locations = payload.get("locations")
+        if not isinstance(locations, list) or len(locations) == 0:
+            raise ValueError("locations must be a non-empty list of location names")
+    if path == "/busy" and not isinstance(payload.get("observation", {}), dict):
+        raise ValueError("observation must be a json object")
+
+    if path == "/preferences":
+        probs = pref.analytic_probability_regions(payload["locations"])
+        return 200, {"probabilities": dict(zip(pref.region_names, probs.tolist()))}
+
+    if path == "/recommend":
+        probs = dict(zip(pref.region_names, pref.analytic_probability_regions(payload["locations"])))
+        rec_obj = rec_file.RecommendTrees(probs, TREE_COUNTS, SEASONS, precision=precision_args(payload))
+        recommendations = rec_obj.recommend_regions(payload["fruit"], float(payload.get("avg_rain", 1.51)),
+                                                    float(payload.get("avg_temp", 60)), k=int(payload.get("k", 1)))
+        response = {"recommendations": [{"location": loc, "score": score} for loc, score in recommendations]}
+        if rec_obj.precision is not None:
+            response["precision"] = rec_obj.precision_report
+        return 200, response
+
+    if path == "/busy":
+        observation = {key: int(value) for key, value in payload.get("observation", {}).items()}
+        args = precision_args(payload)
+        if args is None:
+            return 200, {"prob_busy": busyBayes.prob_busy(observation, net=_MODELS["net"])}
+        result = busyBayes.likelihood_weighting_to_precision(observation, net=_MODELS["net"], **args)
+        return 200, {"prob_busy": result["prob"], "precision": {key: result[key] for key in
+                                                                 ("se", "n_samples", "elapsed", "converged", "reason")}}
+
+    return 404, {"error": f"unknown endpoint {path}"}
+
+
+def safe_handle(path, payload):
+    # every request gets a json answer: bad input is a 400 and anything else that goes wrong a 500
+    try:
+        return handle(path, payload)
+    except (KeyError, ValueError, TypeError, IndexError) as e:
+        return 400, {"error": f"{type(e).__name__}: {e}"}
+    except Exception as e:
+        return 500, {"error": f"{type(e).__name__}: {e}"}
+
+
+class RecommendationService:
+    def __init__(self, host="127.0.0.1", port=8765, workers=2):
+        """
+        Long-running HTTP service answering preference, recommendation and busyness requests with warm models
+
+        Parameters:
+        host: string
+            address to bind, localhost by default
+        port: int
+            port to listen on
+        workers: int
+            number of worker processes for the CPU-bound work
+        """
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.executor = None
+        self.server = None
+
+    async def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+        # make sure every worker is warm before taking requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, safe_handle, "/busy", {}) for _ in range(self.workers)])
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except ValueError as e:
+                    # the request itself can't be parsed, so answer it and drop the connection
+                    await self.respond(writer, 400, {"error": f"malformed request: {e}"}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, length = request
+
+                if length > MAX_BODY_BYTES:
+                    status, response = 413, {"error": "request body too large"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, response = await self.dispatch(method, path, body)
+
+                # an unread body would be taken for the next request, so a 413 closes the connection
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close" and status != 413
+                await self.respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """
+        Read the request line and headers of the next request on a connection. Returns (method, path, headers,
+        content length), or None once the client has closed the connection. Raises ValueError if they are malformed.
+        """
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise ValueError("request line must be <method> <path> <version>")
+        method, path, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, sep, value = line.decode("latin-1").partition(":")
+            if not sep:
+                raise ValueError(f"bad header line {line!r}")
+            headers[key.strip().lower()] = value.strip()
+
+        length = headers.get("content-length", "0")
+        if not length.isdigit():
+            raise ValueError(f"bad Content-Length {length!r}")
+        return method, path, headers, int(length)
+
+    async def respond(self, writer, status, response, keep_alive=True):
+        data = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+        await writer.drain()
+
+    async def dispatch(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        try:
+            payload = json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            return 400, {"error": "body is not valid json"}
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, safe_handle, path, payload)
+        except Exception as e:
+            # the worker itself failed, e.g. a broken process pool
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+
+async def run(host, port, workers):
+    service = await RecommendationService(host, port, workers).start()
+    print(f"BirdFeeder service listening on http://{service.host}:{service.port}")
+    try:
+        await service.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the BirdFeeder recommendation service.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to bind")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=2, help="number of worker processes")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(run(args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,11 +1,10 @@
+from collections import OrderedDict
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.stats import multivariate_normal
-import pandas as pd
 
 
 class LocationPref:
-    def __init__(self, campus_boundary, map_dict, map_locs):
+    def __init__(self, campus_boundary, map_dict, map_locs, grid_size=100, dtype=np.float64, mode="grid",
+                 max_pdf_cache_bytes=256 * 2**20):
         """
         Initialize Location Preference PDF
 
@@ -15,35 +14,189 @@ class LocationPref:
         map_dict: dict
             {location: [x_c, y_c]} defining the center points of each location
         map_locs: dict
-            {location: [(x1, x2), (y1, y2)]} defining the coordinates of the boundary for each location
+            {location: [(x1, x2), (y1, y2)]} defining the coordinates of the boundary for each location,
+            or {location: [(x, y), (x, y), (x, y), ...]} with the vertices of a polygon
+        grid_size: int
+            number of grid cells along each side of the campus
+        dtype: numpy dtype
+            float type of the grids, np.float32 halves the memory of large grids
+        mode: string
+            "grid" to get location probabilities by summing the pdf over the grid, "analytic" to get them from
+            gaussian CDFs (rectangular regions only). In analytic mode the grid is only built if a pdf is requested,
+            e.g. for visualize.
+        max_pdf_cache_bytes: int
+            memory the memoized pdfs may take, the least recently used ones are dropped first (0 turns it off)
         """
         
         self.campus_boundary = campus_boundary
-        self.grid_size = 100
+        self.grid_size = grid_size
+        self.dtype = np.dtype(dtype)
         self.dict = map_dict
         self.locs = map_locs
+        self.spread = 0.15
+        self.mode = mode
+        self.region_names = list(map_locs.keys())
 
-        x1, x2, y1, y2 = campus_boundary
-        x = np.linspace(x1, x2, self.grid_size)
-        y = np.linspace(y1, y2, self.grid_size)
-        self.X, self.Y = np.meshgrid(x, y)
-        self.grid = np.dstack((self.X, self.Y))
+        # 1-D gaussian factors of each location and full pdfs, filled in as they are first needed
+        self.kernel_cache = {}
+        self.pdf_cache = OrderedDict()
+        self.max_pdf_cache_bytes = max_pdf_cache_bytes
+
+        self.X = None
+        if mode == "grid":
+            self.build_grid()
+        elif mode != "analytic":
+            raise ValueError(f"unknown mode {mode}")
+
+    def build_grid(self):
+        """
+        Build the grid, the region label raster and the cell index of probability_regions, if they have not been built yet
+        """
+        if self.X is not None:
+            return
+        # points at the centers of grid_size x grid_size equal cells, so no point sits on a region edge and
+        # every cell is counted once without favouring either side of a shared boundary
+        x1, x2, y1, y2 = self.campus_boundary
+        centers = (np.arange(self.grid_size) + 0.5) / self.grid_size
+        self.x = (x1 + centers * (x2 - x1)).astype(self.dtype)
+        self.y = (y1 + centers * (y2 - y1)).astype(self.dtype)
+        self.X, self.Y = np.meshgrid(self.x, self.y)
+
+        # label of the region every grid cell belongs to (-1 for none)
+        self.labels = self.label_raster()
+
+        # flat region index of every cell for probability_regions, with one extra bin for the cells outside every
+        # region and for the cells cut by a rectangle edge, which are added from the sparse edge_cells list instead
+        self.edge_index, self.edge_labels, self.edge_weights = self.edge_cells()
+        self.cell_labels = np.where(self.labels >= 0, self.labels, len(self.region_names)).ravel().astype(np.intp)
+        self.cell_labels[self.edge_index] = len(self.region_names)
+
+    def cell_fractions(self, lo, hi, spans):
+        """
+        (n_spans x grid_size) fraction of each of the grid_size equal cells between lo and hi that lies inside each
+        (start, end) span
+        """
+        edges = lo + np.arange(self.grid_size + 1) / self.grid_size * (hi - lo)
+        spans = np.asarray(spans, dtype=float).reshape(-1, 2)
+        overlap = np.minimum(edges[None, 1:], spans[:, 1:]) - np.maximum(edges[None, :-1], spans[:, :1])
+        return np.clip(overlap, 0, None) / np.diff(edges)[None, :]
+
+    def edge_cells(self):
+        """
+        Sparse (flat cell index, region, weight) arrays for the cells cut by a rectangle edge. When the grid doesn't
+        line up with the regions, counting such a cell by its center would hand the whole cell to one side, so instead
+        it is split between the rectangles by the share of its area inside each. Rectangles take their share in region
+        order, so where they overlap the first one still wins, and what is left of the cell goes to the polygon its
+        center is in (if any).
+        """
+        x1, x2, y1, y2 = self.campus_boundary
+        rect_ids = [label for label, region in enumerate(self.locs.values()) if len(region) == 2]
+        rects = [self.locs[self.region_names[label]] for label in rect_ids]
+        fx = self.cell_fractions(x1, x2, [rect[0] for rect in rects])
+        fy = self.cell_fractions(y1, y2, [rect[1] for rect in rects])
+
+        # cells partly inside some rectangle: the partial columns and partial rows of each rectangle's footprint
+        cut = np.zeros(self.X.shape, dtype=bool)
+        for k in range(len(rects)):
+            rows, cols = fy[k] > 0, fx[k] > 0
+            cut[np.ix_(rows, cols & (fx[k] < 1))] = True
+            cut[np.ix_(rows & (fy[k] < 1), cols)] = True
+
+        # share of every cut cell inside every rectangle that covers part of it
+        cells, regions, shares = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)], [np.zeros(0)]
+        for k, label in enumerate(rect_ids):
+            rows, cols = np.flatnonzero(fy[k] > 0), np.flatnonzero(fx[k] > 0)
+            r, c = np.nonzero(cut[np.ix_(rows, cols)])
+            cells.append(rows[r] * self.grid_size + cols[c])
+            regions.append(np.full(len(r), label, dtype=np.intp))
+            shares.append(fy[k, rows[r]] * fx[k, cols[c]])
+        cells, regions, shares = np.concatenate(cells), np.concatenate(regions), np.concatenate(shares)
+        order = np.lexsort((regions, cells))
+        cells, regions, shares = cells[order], regions[order], shares[order]
+
+        # first one wins: each rectangle only gets what the earlier ones left of the cell
+        taken = np.cumsum(shares)
+        starts = np.flatnonzero(np.diff(cells, prepend=-1))
+        taken -= np.repeat(taken[starts] - shares[starts], np.diff(np.r_[starts, len(cells)]))
+        weights = np.minimum(taken, 1) - np.minimum(taken - shares, 1)
+
+        # the rest of the cell goes to a polygon through the label of its center
+        cut_index = cells[starts]
+        rest = 1 - np.add.reduceat(weights, starts) if len(cells) else np.zeros(0)
+        rest_labels = self.labels.ravel()[cut_index]
+        to_polygon = (rest > 0) & (rest_labels >= 0) & ~np.isin(rest_labels, rect_ids)
+        return (np.concatenate([cells, cut_index[to_polygon]]), np.concatenate([regions, rest_labels[to_polygon]]),
+                np.concatenate([weights, rest[to_polygon]]))
+
+    def label_raster(self):
+        """
+        Assign every grid cell (by its center) to at most one region. Rectangles are half-open ([x1, x2) x [y1, y2))
+        so a center on a shared edge can't be counted twice; where regions overlap the first one wins.
+        """
+        labels = np.full(self.X.shape, -1, dtype=np.int32)
+        for label, region in enumerate(self.locs.values()):
+            if len(region) == 2:
+                # only touch the rows and columns of the rectangle, not the whole grid
+                (x1, x2), (y1, y2) = region
+                block = np.ix_((self.y >= y1) & (self.y < y2), (self.x >= x1) & (self.x < x2))
+                inside = labels[block]
+                inside[inside < 0] = label
+                labels[block] = inside
+            else:
+                labels[self.in_polygon(region) & (labels < 0)] = label
+        return labels
+
+    def in_polygon(self, vertices):
+        """
+        Boolean grid of the cells whose centers are inside the polygon (even-odd ray casting)
+        """
+        vertices = np.asarray(vertices, dtype=float)
+        inside = np.zeros(self.X.shape, dtype=bool)
+        for (xi, yi), (xj, yj) in zip(vertices, np.roll(vertices, -1, axis=0)):
+            if yi == yj:
+                continue
+            crosses = (yi > self.Y) != (yj > self.Y)
+            inside ^= crosses & (self.X < (xj - xi) * (self.Y - yi) / (yj - yi) + xi)
+        return inside
+
+    @property
+    def grid(self):
+        self.build_grid()
+        return np.dstack((self.X, self.Y))
+
+    def location_kernel(self, loc):
+        """
+        1-D gaussians (gx over self.x, gy over self.y) of a location. The covariance is isotropic, so the density of
+        the location over the grid is their outer product, and only these O(grid_size) factors are cached.
+        """
+        if loc not in self.kernel_cache:
+            self.build_grid()
+            mean_x, mean_y = self.dict[loc]
+            var = self.spread
+            norm = 1 / np.sqrt(2 * np.pi * var)
+            gx = norm * np.exp(-(self.x.astype(np.float64) - mean_x) ** 2 / (2 * var))
+            gy = norm * np.exp(-(self.y.astype(np.float64) - mean_y) ** 2 / (2 * var))
+            self.kernel_cache[loc] = gx, gy
+        return self.kernel_cache[loc]
 
     def create_pref_pdf(self, preferred_locs):
         """
-        Create PDF using Gaussian Mixture Model for User Preferences over Grid
+        Create PDF using Gaussian Mixture Model for User Preferences over Grid.
+        Recent results are memoized by the preferred locations (up to max_pdf_cache_bytes), so treat the returned
+        array as read-only.
 
         Parameters:
         preferred_locs: list
             List of names of preferred locations
         """
 
-        n_locs = len(preferred_locs)
+        key = tuple(sorted(preferred_locs))
+        if key in self.pdf_cache:
+            self.pdf_cache.move_to_end(key)
+            return self.pdf_cache[key]
 
-        # get coords of preferred locs
-        pref_locs_coords = []
-        for i in preferred_locs:
-            pref_locs_coords.append(self.dict[i])
+        self.build_grid()
+        n_locs = len(preferred_locs)
 
         # get weights for each gaussian in gmm
         pref_strengths = [1.0] * n_locs
@@ -51,18 +204,11 @@ class LocationPref:
         total_strength = sum(pref_strengths)
         weights = [s / total_strength for s in pref_strengths]
 
-        spreads = [0.15] * n_locs
-
-        # define mean, weight, cov and then get gmm 
-        pref_dist = np.zeros_like(self.X)
-        for i in range(n_locs):
-            mean = pref_locs_coords[i]
-            weight = weights[i]
-            cov = np.eye(2) * spreads[i]
-
-            # create gaussian dist with mean and cov defined above 
-            gaussian = multivariate_normal(mean=mean, cov=cov)
-            pref_dist += weight * gaussian.pdf(self.grid)
+        # weighted sum of the gaussian of each preferred location, sum_i w_i outer(gy_i, gx_i), as one matmul
+        kernels = [self.location_kernel(loc) for loc in preferred_locs]
+        Gx = np.array([gx for gx, _ in kernels], dtype=self.dtype).reshape(n_locs, -1)
+        Gy = np.array([gy for _, gy in kernels], dtype=self.dtype).reshape(n_locs, -1)
+        pref_dist = Gy.T @ (np.asarray(weights, dtype=self.dtype)[:, None] * Gx)
 
         # normalize to get pdf
         if np.sum(pref_dist) > 0:
@@ -70,6 +216,11 @@ class LocationPref:
         
         # print("sum pref dist:", sum(sum(pdf)))
         
+        pdf.flags.writeable = False
+        if pdf.nbytes <= self.max_pdf_cache_bytes:
+            self.pdf_cache[key] = pdf
+            while sum(cached.nbytes for cached in self.pdf_cache.values()) > self.max_pdf_cache_bytes:
+                self.pdf_cache.popitem(last=False)
         return pdf
     
 
@@ -77,6 +228,9 @@ class LocationPref:
         """
         Visualize the campus map with user preferences
         """
+        # matplotlib is only loaded when something is actually plotted
+        import matplotlib.pyplot as plt
+        self.build_grid()
         fig, ax = plt.subplots(figsize=(8, 6))
         
         contour = ax.contourf(self.X, self.Y, user_preference_distribution, 
@@ -96,30 +250,82 @@ class LocationPref:
         plt.tight_layout()
         return fig, ax
     
-    def probability_locs(self, pdf):
+    def probability_regions(self, pdf):
         """
-        Get probability of each location from the PDF.
+        Get probability of each region (in the order of self.region_names) from the PDF, in one pass over the labeled
+        cells. Cells cut by a rectangle edge are split between the regions by area, see edge_cells.
         Parameters:
         pdf: numpy array
             probability density function of the locations that the user prefers/is most likely to go to
         """
-        loc_probs = np.zeros((self.campus_boundary[1], self.campus_boundary[3]))
-        cell_area = 1
+        self.build_grid()
+        pdf = np.asarray(pdf)
+        n_regions = len(self.region_names)
+        region_probs = np.bincount(self.cell_labels, weights=pdf.ravel(), minlength=n_regions + 1)[:n_regions]
+        region_probs += np.bincount(self.edge_labels, weights=pdf.ravel()[self.edge_index] * self.edge_weights,
+                                    minlength=n_regions)
 
-        for inds in (self.locs).values():
-            x1 = inds[0][0]
-            x2 = inds[0][1]
-            y1 = inds[1][0]
-            y2 = inds[1][1]
-            mask = (self.X >= x1) & (self.X <= x2) & \
-                (self.Y >= y1) & (self.Y <= y2)
+        # normalize to ensure probs sum to 1
+        return region_probs / np.sum(region_probs)
+
+    def analytic_probability_regions(self, preferred_locs):
+        """
+        Get probability of each region (in the order of self.region_names) straight from the gaussian mixture,
+        without a grid. The covariance of each gaussian is isotropic, so its mass over a rectangle is the product of
+        two 1-D normal CDF differences.
+        Parameters:
+        preferred_locs: list
+            List of names of preferred locations
+        """
+        bounds = np.array([[region[0][0], region[0][1], region[1][0], region[1][1]] if len(region) == 2 else [np.nan] * 4
+                           for region in self.locs.values()], dtype=float)
+        if np.isnan(bounds).any():
+            raise ValueError("analytic probabilities need rectangular regions")
+
+        from scipy.special import ndtr
+        # equal weights for each gaussian in the gmm, so they drop out in the normalization
+        means = np.array([self.dict[loc] for loc in preferred_locs], dtype=float)
+        sd = np.sqrt(self.spread)
+        cdf = lambda lim, mean: ndtr((lim[None, :] - mean[:, None]) / sd)
+        mass_x = cdf(bounds[:, 1], means[:, 0]) - cdf(bounds[:, 0], means[:, 0])
+        mass_y = cdf(bounds[:, 3], means[:, 1]) - cdf(bounds[:, 2], means[:, 1])
+        region_probs = np.sum(mass_x * mass_y, axis=0)
 
-            loc_probs[x1][y1] = np.sum(pdf[mask]) * cell_area
-        
         # normalize to ensure probs sum to 1
-        loc_probs = loc_probs / np.sum(loc_probs)
+        return region_probs / np.sum(region_probs)
+
+    def regions_to_matrix(self, region_probs):
+        """
+        Lay out region probabilities as a matrix with the probability of the rectangle [(x1, x2), (y1, y2)] at [x1][y1]
+        """
+        loc_probs = np.zeros((self.campus_boundary[1], self.campus_boundary[3]))
+
+        for prob, inds in zip(region_probs, self.locs.values()):
+            if len(inds) == 2:
+                loc_probs[inds[0][0]][inds[1][0]] = prob
 
         return loc_probs
+
+    def pref_probability_locs(self, preferred_locs):
+        """
+        Get probability of each location for a list of preferred locations, with the method picked by self.mode
+        Parameters:
+        preferred_locs: list
+            List of names of preferred locations
+        """
+        if self.mode == "analytic":
+            return self.regions_to_matrix(self.analytic_probability_regions(preferred_locs))
+        return self.probability_locs(self.create_pref_pdf(preferred_locs))
+
+    def probability_locs(self, pdf):
+        """
+        Get probability of each location from the PDF, as a matrix with the probability of the rectangle
+        [(x1, x2), (y1, y2)] at [x1][y1]. Polygon regions only appear in probability_regions.
+        Parameters:
+        pdf: numpy array
+            probability density function of the locations that the user prefers/is most likely to go to
+        """
+        return self.regions_to_matrix(self.probability_regions(pdf))
     
 
 # if __name__ == "__main__":
@@ -1,68 +1,133 @@
+import os
+import sys
 import random
-from scipy import stats
-from scipy.stats import bernoulli
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import json
 import numpy as np
 
-def generate_rainfall():
-    if bernoulli.rvs(0.5):
-        avg_rain = [4, 4, 2.5, 1.5, 0.75, 0.5, 0.1, 0.1, 0, 1.5, 3, 5]
-        std_devs = [1, 1, 1, 0.5, 1, 0.5, 0.5, 0.5, 0.5, 1, 0.8, 1.2]
-    else:
-        avg_rain = [1, 1, 1, 1, 0.75, 0.5, 0.1, 0.1, 0, 1.5, 1, 1]
-        std_devs = [1, 1, 1, 0.5, 1, 0.5, 0.5, 0.5, 0.5, 1, 0.8, 1.2]
-    # Pair the avg temps and st.devs above, then go thru them as pairs (the zip fn does this)
-    # each temp/stdev pairing is used as params in normal to get one sample for each month of the year.
-    rainfall = tuple(abs(round(stats.norm(loc=mu, scale=sigma).rvs(), 1)) for mu, sigma in zip(avg_rain, std_devs))
-    print(np.mean(rainfall))
-    return rainfall
-
-
-def generate_temperature():
-    """Generate monthly temperature data using a normal distribution."""
-    # Average temperatures (°F) for norCal by month
-    if bernoulli.rvs(0.45):
-        avg_temps = [49, 49, 49, 55, 60, 70, 70, 72, 70, 60, 54, 50]
-        std_devs = [2, 3, 1, 1, 1, 2, 3, 2, 4, 3, 2, 2]
-    elif bernoulli.rvs(0.5):
-        avg_temps = [50, 49, 54, 55, 58, 60, 70, 71, 70, 66, 54, 54]
-        std_devs = [2, 3, 1, 1, 1, 2, 3, 2, 4, 3, 2, 2]
-    else:
-        avg_temps = [60, 61, 63, 68, 70, 75, 80, 78, 75, 76, 65, 63]
-        std_devs = [2, 3, 1, 1, 1, 2, 3, 2, 4, 3, 2, 2]
+import weatherStore
+
+# monthly rainfall (inches) in a wet and a dry year, each picked with probability 0.5
+WET_RAIN = [4, 4, 2.5, 1.5, 0.75, 0.5, 0.1, 0.1, 0, 1.5, 3, 5]
+DRY_RAIN = [1, 1, 1, 1, 0.75, 0.5, 0.1, 0.1, 0, 1.5, 1, 1]
+RAIN_STD = [1, 1, 1, 0.5, 1, 0.5, 0.5, 0.5, 0.5, 1, 0.8, 1.2]
+
+# monthly temperature (°F) in a cool, mild and hot year with their probabilities
+TEMP_REGIMES = [
+    [49, 49, 49, 55, 60, 70, 70, 72, 70, 60, 54, 50],
+    [50, 49, 54, 55, 58, 60, 70, 71, 70, 66, 54, 54],
+    [60, 61, 63, 68, 70, 75, 80, 78, 75, 76, 65, 63],
+]
+TEMP_REGIME_PROBS = [0.45, 0.275, 0.275]
+TEMP_STD = [2, 3, 1, 1, 1, 2, 3, 2, 4, 3, 2, 2]
+
+# coefficients of the per-month yield model
+# yield = intercept + temp * T + rain * R + temp_sq * T^2 + rain_sq * R^2 + temp_rain * T * R, clipped at 0
+YIELD_MODELS = {
+    "orange": {"intercept": 180, "temp": 10, "rain": 5, "temp_sq": -0.2, "rain_sq": -0.05, "temp_rain": 0.5},
+    "pomegranate": {"intercept": 10, "temp": 7, "rain": 3, "temp_sq": -0.15, "rain_sq": -0.07, "temp_rain": 0.3},
+}
+
+# ways of turning the 12 monthly yields into the yield of the year. "last" is what the historical data was built with.
+MONTHLY_AGGREGATES = {
+    "last": lambda monthly: monthly[..., -1],
+    "mean": lambda monthly: np.mean(monthly, axis=-1),
+    "sum": lambda monthly: np.sum(monthly, axis=-1),
+    "max": lambda monthly: np.max(monthly, axis=-1),
+}
 
-    # Pair the avg temps and st.devs above, then go thru them as pairs (the zip fn does this)
-    # each temp/stdev pairing is used as params in normal to get one sample for each month of the year.
-    temperatures = tuple(round(stats.norm(loc=mu, scale=sigma).rvs(), 1) for mu, sigma in zip(avg_temps, std_devs))
+FRUITS = list(YIELD_MODELS)
+
+def generate_rainfall(rng=None):
+    """Generate one year of monthly rainfall, a thin wrapper over generate_years."""
+    rainfall, _ = generate_years(1, np.random.default_rng(rng))
+    return tuple(rainfall[0].tolist())
+
+
+def generate_temperature(rng=None):
+    """Generate one year of monthly temperature data, a thin wrapper over generate_years."""
+    _, temperature = generate_years(1, np.random.default_rng(rng))
     #you'll get a TUPLE of TWELVE values.
-    #print(np.mean(temperatures))
-    return temperatures
+    return tuple(temperature[0].tolist())
+
+
+def register_yield_model(fruit, coefficients):
+    """
+    Add or replace the yield model of a fruit
+
+    Parameters:
+    fruit: string
+        name of the fruit
+    coefficients: dict
+        {"intercept", "temp", "rain", "temp_sq", "rain_sq", "temp_rain"} coefficients of the monthly polynomial
+    """
+    missing = {"intercept", "temp", "rain", "temp_sq", "rain_sq", "temp_rain"} - set(coefficients)
+    if missing:
+        raise ValueError(f"yield model for {fruit} is missing {sorted(missing)}")
+    YIELD_MODELS[fruit] = dict(coefficients)
+    if fruit not in FRUITS:
+        FRUITS.append(fruit)
+
+
+def monthly_yield(rainfall, temperature, fruitType, models=YIELD_MODELS):
+    """
+    Yield of every month for arrays of rainfall and temperature of any shape (e.g. (n_years, 12)), clipped at 0
+    """
+    if fruitType not in models:
+        raise ValueError(f"unknown fruit {fruitType}")
+    c = models[fruitType]
+    rain = np.asarray(rainfall, dtype=float)
+    temp = np.asarray(temperature, dtype=float)
+    fruitYield = c["intercept"] + temp * (c["temp"] + c["temp_sq"] * temp + c["temp_rain"] * rain) + rain * (c["rain"] + c["rain_sq"] * rain)
+    return np.maximum(fruitYield, 0)
 
 
+def evaluate_yield(rainfall, temperature, fruitType, aggregate="last", models=YIELD_MODELS):
+    """
+    Yield of every year for (n_years, 12) arrays of rainfall and temperature, returns an (n_years,) array
+
+    Parameters:
+    rainfall, temperature: numpy arrays
+        monthly values with the months along the last axis
+    fruitType: string
+        name of a fruit in models
+    aggregate: string
+        key of MONTHLY_AGGREGATES used to combine the monthly yields into a yearly one
+    models: dict
+        {fruit: coefficients}, defaults to the registered YIELD_MODELS
+    """
+    return np.round(MONTHLY_AGGREGATES[aggregate](monthly_yield(rainfall, temperature, fruitType, models)))
+
 
 def calculate_fruit_yield(rainfall, temperature, fruitType):
     """Calculate fruit yield based on rainfall and temperature conditions."""
 
-    if fruitType == "orange":
-        for month in range(12):
-            fruitYield = 180 + (10 * temperature[month]) + (5 * rainfall[month]) - (0.2 * (temperature[month] ** 2)) - (0.05 * (rainfall[month] ** 2)) + (0.5 * temperature[month] * rainfall[month])
-            if fruitYield < 0:
-                fruitYield = 0
+    return int(evaluate_yield(np.asarray(rainfall)[None, :], np.asarray(temperature)[None, :], fruitType)[0])
+
 
-    if fruitType == "pomegranate":
-        for month in range(12):
-            fruitYield = 10 + (7 * temperature[month]) + (3 * rainfall[month]) - (0.15 * (temperature[month] ** 2)) - (0.07 * (rainfall[month] ** 2)) + (0.3 * temperature[month] * rainfall[month])
-            if fruitYield < 0:
-                fruitYield = 0
-        # if fruitMean > 15:
-        #     fruitMean = 15
-    # fruitVariance = fruitMean * 0.1
-    # fruitGaussian = stats.norm(fruitMean, fruitVariance)
+def rescore_history(store, fruits=None, aggregate="last", models=YIELD_MODELS):
+    """
+    Recompute the yields of every year of a WeatherStore, e.g. after changing a yield model.
+    Returns a new in-memory WeatherStore with the same weather and the new yields.
 
-    return round(fruitYield)
+    Parameters:
+    store: WeatherStore
+        history to rescore
+    fruits: list
+        fruits to score, defaults to every fruit in models
+    aggregate: string
+        key of MONTHLY_AGGREGATES
+    models: dict
+        {fruit: coefficients}
+    """
+    arrays = {"years": np.asarray(store.years), "rain": np.asarray(store.rain), "temp": np.asarray(store.temp)}
+    for fruit in (fruits if fruits is not None else list(models)):
+        arrays[f"yield_{fruit}"] = evaluate_yield(arrays["rain"], arrays["temp"], fruit, aggregate, models)
+    return weatherStore.WeatherStore.from_arrays(arrays)
 
 
-def simulateWeatherData():
+def simulateWeatherData(n_years=31, seed=None):
     """
     This function simulates data tying temperature and rainfall to AVERAGE fruit
     production on orange and pomegranate plants at Stanford. It contains a dictionary of years,
@@ -71,28 +136,132 @@ def simulateWeatherData():
     - "temperature" <- length-12 tuple of monthly temps
     - "oranges" <- average orange production across Stanford trees for the year
     - "pomegranates" <- average pomegranate production across Stanford bushes for the year
+
+    n_years: int
+        number of years to simulate, starting from 1995
+    seed: int or None
+        seed for a reproducible history
     """
+    store = simulate_history(n_years, seed)
     weather_data = {}
-    for year in range(1995, 2026):
-        rainfall = generate_rainfall()
-        temperature = generate_temperature()
-        orange_yield = calculate_fruit_yield(rainfall, temperature, "orange")
-        pomegranate_yield = calculate_fruit_yield(rainfall, temperature, "pomegranate")
-
-
-        weather_data[year] = [
-            {"rainfall": rainfall},
-            {"temperature": temperature},
-            {"oranges": orange_yield},
-            {"pomegranates": pomegranate_yield}
+    for i, year in enumerate(store.years):
+        weather_data[int(year)] = [
+            {"rainfall": store.rain[i].tolist()},
+            {"temperature": store.temp[i].tolist()},
+            {"oranges": int(store.yields["orange"][i])},
+            {"pomegranates": int(store.yields["pomegranate"][i])}
         ]
     return weather_data
 
 
-weatherData = simulateWeatherData()
-#print(weatherData)
+def generate_years(n_years, rng):
+    """
+    Draw n_years of weather at once.
+
+    Parameters:
+    n_years: int
+        number of years to simulate
+    rng: numpy Generator
+        random number generator to draw from
+
+    Returns (rainfall, temperature) as two (n_years, 12) arrays.
+    """
+    wet = rng.random(n_years) < 0.5
+    rain_means = np.where(wet[:, None], WET_RAIN, DRY_RAIN)
+    rainfall = np.abs(np.round(rng.normal(rain_means, RAIN_STD), 1))
+
+    regimes = rng.choice(len(TEMP_REGIMES), size=n_years, p=TEMP_REGIME_PROBS)
+    temp_means = np.asarray(TEMP_REGIMES, dtype=float)[regimes]
+    temperature = np.round(rng.normal(temp_means, TEMP_STD), 1)
+    return rainfall, temperature
+
+
+def _simulate_chunk(seed, n_years):
+    # one chunk of history in the WeatherStore layout (without years)
+    rng = np.random.default_rng(seed)
+    rainfall, temperature = generate_years(n_years, rng)
+    arrays = {"rain": rainfall, "temp": temperature}
+    for fruit in FRUITS:
+        arrays[f"yield_{fruit}"] = evaluate_yield(rainfall, temperature, fruit)
+    return arrays
+
+
+def simulate_history(n_years, seed=None, workers=1, chunk_years=100000, out_dir=None, start_year=1995):
+    """
+    Simulate a long weather history in chunks. Every chunk gets its own stream spawned from one SeedSequence,
+    so the result only depends on seed and chunk_years, not on the number of workers.
+
+    Parameters:
+    n_years: int
+        number of years to simulate
+    seed: int or None
+        seed of the SeedSequence
+    workers: int
+        number of processes drawing chunks
+    chunk_years: int
+        number of years per chunk
+    out_dir: string or None
+        if given, chunks are streamed into memory-mapped .npy files in this directory as they finish, and the
+        directory can be opened with weatherStore.WeatherStore.open. Otherwise the arrays are kept in memory.
+    start_year: int
+        label of the first simulated year
+
+    Returns a WeatherStore over the simulated history.
+    """
+    starts = list(range(0, n_years, chunk_years))
+    sizes = [min(chunk_years, n_years - start) for start in starts]
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+
+    shapes = {"years": (n_years,), "rain": (n_years, 12), "temp": (n_years, 12)}
+    shapes.update({f"yield_{fruit}": (n_years,) for fruit in FRUITS})
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        arrays = {key: np.lib.format.open_memmap(os.path.join(out_dir, f"{key}.npy"), mode="w+", dtype=np.int64 if key == "years" else float, shape=shape)
+                  for key, shape in shapes.items()}
+    else:
+        arrays = {key: np.empty(shape, dtype=np.int64 if key == "years" else float) for key, shape in shapes.items()}
+    arrays["years"][:] = np.arange(start_year, start_year + n_years)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(_simulate_chunk, seeds, sizes)
+            for start, size, chunk in zip(starts, sizes, chunks):
+                for key, value in chunk.items():
+                    arrays[key][start:start + size] = value
+    else:
+        for start, size, chunk_seed in zip(starts, sizes, seeds):
+            for key, value in _simulate_chunk(chunk_seed, size).items():
+                arrays[key][start:start + size] = value
+
+    if out_dir is None:
+        return weatherStore.WeatherStore.from_arrays(arrays)
+    for value in arrays.values():
+        value.flush()
+    weatherStore.write_meta(out_dir, arrays)
+    return weatherStore.WeatherStore.open(out_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate weather and fruit yield history.")
+    parser.add_argument("--years", type=int, default=31, help="number of years to simulate")
+    parser.add_argument("--seed", type=int, default=None, help="seed for reproducible histories")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes")
+    parser.add_argument("--chunk-years", type=int, default=100000, help="years simulated per chunk")
+    parser.add_argument("--out", default=None, help="directory for the columnar .npy store")
+    parser.add_argument("--json", default="weatherData.json", help="json file written when --out is not given")
+    args = parser.parse_args(argv)
+
+    if args.out is not None:
+        store = simulate_history(args.years, args.seed, args.workers, args.chunk_years, args.out)
+        print(f"Wrote {len(store)} years to {args.out}")
+        return
+
+    weatherData = simulateWeatherData(args.years, args.seed)
+    # saving weatherData into json format
+    with open(args.json, 'w') as f:
+        json.dump(weatherData, f)
+    print(f"Wrote {len(weatherData)} years to {args.json}")
 
-# saving weatherData into json format
-with open('weatherData.json', 'w') as f:
-    json.dump(weatherData, f)
 
+if __name__ == "__main__":
+    main(sys.argv[1:])
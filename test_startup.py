@@ -0,0 +1,6 @@
+import benchmarks
+
+
+def test_import_time():
+    # every entry point imports within benchmarks.IMPORT_TIME_TARGET seconds and without the heavy packages
+    assert benchmarks.check_import_time() == []
@@ -0,0 +1,130 @@
+import numpy as np
+
+
+class TreeRegistry:
+    def __init__(self, ids, fruits, x, y, regions, region_names=None):
+        """
+        Array-backed registry of individual fruit trees with a KD-tree over their coordinates
+
+        Parameters:
+        ids: list
+            id of every tree
+        fruits: list
+            fruit name of every tree
+        x, y: list
+            coordinates of every tree
+        regions: list
+            name of the region (location) every tree is in
+        region_names: list
+            every region of the map in map order, including regions without trees. Defaults to the regions of the
+            trees in the order they first appear.
+        """
+        self.ids = np.asarray(ids)
+        self.fruit_names, self.fruit_codes = np.unique(np.asarray(fruits, dtype=str), return_inverse=True)
+        self.fruit_names = self.fruit_names.tolist()
+        regions = [str(region) for region in regions]
+        self.region_names = list(dict.fromkeys(regions)) if region_names is None else [str(name) for name in region_names]
+        lookup = {name: code for code, name in enumerate(self.region_names)}
+        missing = set(regions) - set(lookup)
+        if missing:
+            raise ValueError(f"trees are in regions missing from region_names: {sorted(missing)}")
+        self.region_codes = np.array([lookup[region] for region in regions], dtype=np.intp)
+        self.coords = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)]).reshape(len(self.ids), 2)
+        self._tree = None
+
+    @classmethod
+    def from_counts(cls, tree_counts, map_dict):
+        """
+        Build a registry from per-location tree counts, placing every tree at the center of its location.
+        Every location of tree_counts is kept as a region, in the same order, even if it has no trees.
+
+        Parameters:
+        tree_counts: dict
+            {location: {fruit: num_trees}} for number of trees of a fruit in a given location
+        map_dict: dict
+            {location: [x_c, y_c]} defining the center points of each location
+        """
+        fruits, x, y, regions = [], [], [], []
+        for loc, counts in tree_counts.items():
+            for fruit, num_trees in counts.items():
+                fruits += [fruit] * num_trees
+                x += [map_dict[loc][0]] * num_trees
+                y += [map_dict[loc][1]] * num_trees
+                regions += [loc] * num_trees
+        return cls(np.arange(len(fruits)), fruits, x, y, regions, region_names=list(tree_counts))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def fruits(self):
+        """
+        Fruit name of every tree
+        """
+        return np.array(self.fruit_names, dtype=object)[self.fruit_codes] if len(self) else np.array([], dtype=object)
+
+    def regions(self):
+        """
+        Region name of every tree
+        """
+        return np.array(self.region_names, dtype=object)[self.region_codes] if len(self) else np.array([], dtype=object)
+
+    def of_fruit(self, fruit, candidates=None):
+        """
+        Indices of the trees of a fruit, optionally only among the given candidate indices
+        """
+        if fruit not in self.fruit_names:
+            return np.array([], dtype=np.intp)
+        candidates = np.arange(len(self)) if candidates is None else np.asarray(candidates, dtype=np.intp)
+        return candidates[self.fruit_codes[candidates] == self.fruit_names.index(fruit)]
+
+    @property
+    def tree(self):
+        # built on first spatial query so plain region lookups never pull in scipy
+        if self._tree is None and len(self) > 0:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self.coords)
+        return self._tree
+
+    def near(self, point, radius=None, k=None):
+        """
+        Indices of the trees within radius of point, or of the k trees closest to it
+        """
+        if self.tree is None:
+            return np.array([], dtype=np.intp)
+        if radius is not None:
+            return np.array(sorted(self.tree.query_ball_point(point, radius)), dtype=np.intp)
+        k = min(k if k is not None else len(self), len(self))
+        _, idx = self.tree.query(point, k=k)
+        return np.atleast_1d(idx).astype(np.intp)
+
+    def closest(self, point, k, candidates=None):
+        """
+        Indices of the k trees closest to point, optionally only among the given candidate indices, closest first.
+        The KD-tree is asked for more and more neighbours (doubling) until k of them are candidates.
+        """
+        wanted = np.zeros(len(self), dtype=bool)
+        wanted[np.arange(len(self)) if candidates is None else np.asarray(candidates, dtype=np.intp)] = True
+        k = min(k, int(np.sum(wanted)))
+        if k <= 0:
+            return np.array([], dtype=np.intp)
+        n = k
+        while True:
+            nearest = self.near(point, k=n)
+            hits = nearest[wanted[nearest]]
+            if len(hits) >= k or n >= len(self):
+                return hits[:k]
+            n *= 2
+
+    def count_matrix(self, locations, fruits):
+        """
+        (location x fruit) matrix of tree counts
+        """
+        counts = np.zeros((len(locations), len(fruits)))
+        for i, loc in enumerate(locations):
+            if loc not in self.region_names:
+                continue
+            in_loc = self.region_codes == self.region_names.index(loc)
+            for j, fruit in enumerate(fruits):
+                if fruit in self.fruit_names:
+                    counts[i, j] = np.sum(in_loc & (self.fruit_codes == self.fruit_names.index(fruit)))
+        return counts
@@ -0,0 +1,255 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+# keys of the yearly yields in weatherData.json and the fruit names used everywhere else
+FRUIT_KEYS = {"oranges": "orange", "pomegranates": "pomegranate"}
+
+# weather data used when no path is given: BIRDFEEDER_WEATHER_DATA if set, otherwise the weatherData.json next to
+# this file. Nothing is read until a store is first used, so the path can still be changed with set_data_path.
+DATA_PATH = os.environ.get("BIRDFEEDER_WEATHER_DATA",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "weatherData.json"))
+
+_STORES = {}
+
+
+def arrays_from_dict(data):
+    """
+    Convert the weatherData.json layout into contiguous arrays
+
+    Parameters:
+    data: dict
+        {year: [{"rainfall": [12 values]}, {"temperature": [12 values]}, {"oranges": yield}, {"pomegranates": yield}]}
+
+    Returns a dict with "years" (n_years,), "rain" and "temp" (n_years, 12) and one "yield_<fruit>" (n_years,) per fruit.
+    """
+    years = list(data.keys())
+    arrays = {
+        "years": np.array([int(year) for year in years], dtype=np.int64),
+        "rain": np.array([data[year][0]["rainfall"] for year in years], dtype=float).reshape(len(years), 12),
+        "temp": np.array([data[year][1]["temperature"] for year in years], dtype=float).reshape(len(years), 12),
+    }
+    for entry in (data[years[0]][2:] if years else []):
+        for key in entry:
+            fruit = FRUIT_KEYS.get(key, key)
+            arrays[f"yield_{fruit}"] = np.array([_find(data[year], key) for year in years], dtype=float)
+    return arrays
+
+
+def _find(year_data, key):
+    for entry in year_data:
+        if key in entry:
+            return entry[key]
+    raise KeyError(key)
+
+
+class WeatherStore:
+    def __init__(self, json_path="weatherData.json", store_dir=None):
+        """
+        Columnar view of the weather history. The json file is converted once into .npy files in store_dir, which
+        are memory-mapped on first use; nothing is read until one of the arrays is accessed.
+
+        Parameters:
+        json_path: string
+            path of the weatherData.json file
+        store_dir: string
+            directory for the converted arrays, defaults to "<json_path without extension>_store"
+        """
+        self.json_path = json_path
+        if store_dir is None and json_path is not None:
+            store_dir = os.path.splitext(json_path)[0] + "_store"
+        self.store_dir = store_dir
+        self._arrays = None
+        self._version = None
+        self._annual = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build an in-memory store (nothing written to disk) from data in the weatherData.json layout
+        """
+        return cls.from_arrays(arrays_from_dict(data))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Build an in-memory store from arrays in the layout returned by arrays_from_dict
+        """
+        store = cls(json_path=None, store_dir=None)
+        store._arrays = {key: np.asarray(value) for key, value in arrays.items()}
+        store._version = _hash_arrays(store._arrays)
+        return store
+
+    @classmethod
+    def open(cls, store_dir):
+        """
+        Open a directory of arrays that has no json source, e.g. one written by simulateWeatherData.simulate_history
+        """
+        return cls(json_path=None, store_dir=store_dir)
+
+    def load(self, retries=5):
+        """
+        Load the arrays, converting the json file first if the converted copy is missing or older than the json file.
+        Several processes may do this at once: files are only ever replaced whole, and the meta file is read again
+        after the arrays are mapped so a conversion finishing in between is picked up instead of mixed in.
+        """
+        if self._arrays is not None:
+            return self
+        for _ in range(retries):
+            meta = read_meta(self.store_dir)
+            if self.json_path is None:
+                if meta is None:
+                    raise FileNotFoundError(f"no weather store in {self.store_dir}")
+            elif meta is None or meta.get("source") != _source_stamp(self.json_path):
+                meta = self.convert(_source_stamp(self.json_path))
+            if meta is None:
+                return self
+            try:
+                arrays = {key: np.load(os.path.join(self.store_dir, f"{key}.npy"), mmap_mode="r") for key in meta["arrays"]}
+            except (OSError, ValueError):
+                # an array was replaced by another process between reading the meta and mapping it
+                continue
+            if read_meta(self.store_dir) == meta:
+                self._arrays = arrays
+                self._version = meta["version"]
+                return self
+        raise RuntimeError(f"weather store in {self.store_dir} kept changing while it was loaded")
+
+    def convert(self, source):
+        """
+        Parse the json file and write its arrays to store_dir. If store_dir cannot be written the arrays are kept
+        in memory instead and None is returned.
+        """
+        with open(self.json_path, "r") as f:
+            arrays = arrays_from_dict(json.load(f))
+        try:
+            os.makedirs(self.store_dir, exist_ok=True)
+            for key, value in arrays.items():
+                save_array(self.store_dir, key, value)
+            return write_meta(self.store_dir, arrays, source)
+        except OSError:
+            self._arrays = arrays
+            self._version = _hash_arrays(arrays)
+            return None
+
+    def __getitem__(self, key):
+        return self.load()._arrays[key]
+
+    @property
+    def years(self):
+        return self["years"]
+
+    @property
+    def rain(self):
+        return self["rain"]
+
+    @property
+    def temp(self):
+        return self["temp"]
+
+    @property
+    def fruits(self):
+        return [key[len("yield_"):] for key in self.load()._arrays if key.startswith("yield_")]
+
+    @property
+    def yields(self):
+        """
+        {fruit: (n_years,) array of yearly yields}
+        """
+        return {fruit: self[f"yield_{fruit}"] for fruit in self.fruits}
+
+    def annual_summary(self):
+        """
+        (average rain, average temp) of every year as two (n_years,) arrays, computed once
+        """
+        if self._annual is None:
+            self._annual = (np.mean(self.rain, axis=1), np.mean(self.temp, axis=1))
+        return self._annual
+
+    @property
+    def version(self):
+        """
+        Hash of the data, changes whenever the history changes
+        """
+        self.load()
+        return self._version
+
+    def __len__(self):
+        return len(self.years)
+
+
+def write_meta(store_dir, arrays, source=None):
+    """
+    Write the meta.json of a store directory whose .npy files are already written, and return it
+    """
+    meta = {"source": source, "version": _hash_arrays(arrays), "arrays": list(arrays.keys())}
+    _replace(os.path.join(store_dir, "meta.json"), lambda f: f.write(json.dumps(meta).encode()))
+    return meta
+
+
+def read_meta(store_dir):
+    """
+    meta.json of a store directory, or None if there is none yet
+    """
+    try:
+        with open(os.path.join(store_dir, "meta.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_array(store_dir, key, value):
+    """
+    Save one array of a store as <key>.npy, replacing any existing file in one step
+    """
+    _replace(os.path.join(store_dir, f"{key}.npy"), lambda f: np.save(f, value))
+
+
+def _replace(path, write):
+    # write to a temp file next to path and rename it over path, so readers only ever see a whole file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def _hash_arrays(arrays, chunk_rows=1 << 16):
+    digest = hashlib.sha1()
+    for key in sorted(arrays):
+        digest.update(key.encode())
+        # hash in row chunks so memory-mapped arrays are never copied whole
+        value = arrays[key]
+        for start in range(0, len(value), chunk_rows):
+            digest.update(np.ascontiguousarray(value[start:start + chunk_rows]).tobytes())
+    return digest.hexdigest()
+
+
+def set_data_path(json_path):
+    """
+    Change the weather data file used by get_store() when no path is given
+    """
+    global DATA_PATH
+    DATA_PATH = json_path
+
+
+def get_store(json_path=None):
+    """
+    Shared WeatherStore for a json file (DATA_PATH by default), so every module uses the same loaded arrays
+    """
+    json_path = DATA_PATH if json_path is None else json_path
+    key = os.path.abspath(json_path)
+    if key not in _STORES:
+        _STORES[key] = WeatherStore(json_path)
+    return _STORES[key]